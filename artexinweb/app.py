@@ -5,12 +5,10 @@ import bottle
 import mongoengine
 
 from artexinweb import controllers
-from artexinweb import handlers
 from artexinweb import settings
 from artexinweb import utils
 
 
-huey = settings.huey  # aliasing
 logging.config.dictConfig(settings.LOGGING)
 
 bottle.TEMPLATE_PATH.insert(0, settings.VIEW_ROOT)
@@ -21,7 +19,6 @@ application.config.load_dict(settings.BOTTLE_CONFIG)
 mongoengine.connect('', host=application.config['database.url'])
 
 utils.discover(controllers)
-utils.discover(handlers)
 
 
 if __name__ == '__main__':
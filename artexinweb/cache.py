@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+
+import redis
+
+from artexinweb import settings
+
+
+logger = logging.getLogger(__name__)
+
+KEY_PREFIX = 'artexinweb:cache:'
+
+
+def get_connection():
+    """Return the redis connection used for caching, which is the same redis
+    server used by the job queue."""
+    if get_connection.connection is None:
+        get_connection.connection = redis.StrictRedis(**settings.REDIS_CONFIG)
+    return get_connection.connection
+get_connection.connection = None
+
+
+def get_or_set(key, ttl, func):
+    """Return the cached value stored under `key`. On a cache miss, the value
+    is computed by calling `func`, and stored for `ttl` seconds. If redis is
+    not accessible, the value is computed on every call.
+
+    :param key:   Cache key string
+    :param ttl:   Expiration of the cached value in seconds
+    :param func:  Callable computing a JSON serializable value
+    :returns:     The cached or computed value
+    """
+    key = KEY_PREFIX + key
+    connection = get_connection()
+    try:
+        cached = connection.get(key)
+    except redis.RedisError:
+        logger.warning("Cache not available.", exc_info=True)
+        return func()
+
+    if cached is not None:
+        return json.loads(cached.decode('utf-8'))
+
+    value = func()
+    try:
+        connection.setex(key, ttl, json.dumps(value))
+    except redis.RedisError:
+        logger.warning("Cache not available.", exc_info=True)
+
+    return value
@@ -1,37 +1,54 @@
 # -*- coding: utf-8 -*-
-import codecs
-import json
 import os
+import shutil
 import uuid
 
 import bottle
 
-from artexinweb import settings, utils
+from artexinweb import cache, exceptions, settings, utils
 from artexinweb.forms import FetchableJobForm, StandaloneJobForm, MetaForm
-from artexinweb.models import Job, Task
+from artexinweb.models import Job, Task, collect_stats
 
 
 @bottle.get('/')
 @bottle.jinja2_view('job_dashboard.html')
 def job_dashboard():
-    return {'erred_job_count': Job.objects.filter(status=Job.ERRED).count(),
-            'erred_status': Job.ERRED}
+    ttl = int(settings.BOTTLE_CONFIG.get('web.dashboard_cache_ttl', 10))
+    stats = cache.get_or_set('dashboard', ttl, collect_stats)
+    return {'erred_job_count': stats['jobs'][Job.ERRED],
+            'erred_status': Job.ERRED,
+            'stats': stats,
+            'job_statuses': Job.STATUSES,
+            'task_statuses': Task.STATUSES}
 
 
 @bottle.get('/jobs/')
 @bottle.jinja2_view('job_list.html')
 def jobs_list():
     status = bottle.request.query.get('status')
-    if status:
-        job_list = Job.objects.filter(status=status)
-    else:
-        job_list = Job.objects.all()
+    cursor = bottle.request.query.get('cursor')
+    page_size = int(settings.BOTTLE_CONFIG.get('web.page_size', 50))
+    try:
+        (job_list, next_cursor) = Job.get_page(status=status,
+                                               cursor=cursor,
+                                               page_size=page_size)
+    except ValueError:
+        bottle.abort(400, "Invalid cursor.")
 
     return {'job_list': job_list,
+            'cursor': cursor,
+            'next_cursor': next_cursor,
             'current_status': status,
             'statuses': Job.STATUSES}
 
 
+def get_max_upload_size():
+    """Return the maximum size of uploads in bytes, as set by the
+    ``web.max_upload_size`` option, or ``None`` if it's not limited."""
+    max_size = settings.BOTTLE_CONFIG.get('web.max_upload_size')
+    return int(max_size) if max_size else None
+
+
 class CreateJobController(object):
 
     forms = {
@@ -44,6 +61,7 @@ class CreateJobController(object):
         meta = form.get_meta()
         Job.create(job_type=job_type,
                    targets=form.urls.data,
+                   priority=form.priority.data,
                    extract=form.extract.data,
                    javascript=form.javascript.data,
                    meta=meta)
@@ -55,17 +73,36 @@ class CreateJobController(object):
         media_root = settings.BOTTLE_CONFIG.get('web.media_root', '')
         upload_dir = os.path.join(media_root, folder_name)
 
+        # requests without a content length are checked while saving
+        max_size = get_max_upload_size()
+
         os.makedirs(upload_dir)
 
         targets = []
-        for uploaded_file in bottle.request.files.getlist('files'):
+        task_fields = dict()
+        for uploaded_file in form.files.data:
             upload_path = os.path.join(upload_dir, uploaded_file.filename)
-            uploaded_file.save(upload_path)
+            try:
+                source_md5 = utils.save_upload(uploaded_file.file,
+                                               upload_path,
+                                               max_size)
+            except exceptions.UploadTooLarge as exc:
+                shutil.rmtree(upload_dir)
+                form.files.errors.append(str(exc))
+                return bottle.jinja2_template('job_standalone.html',
+                                              form=form,
+                                              job_type=job_type)
+
             targets.append(upload_path)
+            # the uploaded archives were already validated by the form
+            task_fields[upload_path] = {'source_md5': source_md5,
+                                        'verified': True}
 
         meta = form.get_meta()
         Job.create(job_type=job_type,
                    targets=targets,
+                   task_fields=task_fields,
+                   priority=form.priority.data,
                    origin=form.origin.data,
                    meta=meta)
         return bottle.redirect('/jobs/')
@@ -77,12 +114,18 @@ class CreateJobController(object):
 
 @bottle.post('/jobs/')
 def jobs_create():
+    # reject oversized uploads before bottle receives the whole request body
+    max_size = get_max_upload_size()
+    if max_size and bottle.request.content_length > max_size:
+        bottle.abort(413, "Upload is larger than {0} bytes.".format(max_size))
+
     job_type = bottle.request.forms.get('type')
 
     if Job.is_valid_type(job_type):
         form_cls = CreateJobController.forms[job_type]
         form_data = bottle.request.forms.decode()
-        form_data.update(bottle.request.files)
+        for (name, uploaded_file) in bottle.request.files.allitems():
+            form_data.append(name, uploaded_file)
         form = form_cls(form_data)
 
         if form.validate():
@@ -115,7 +158,7 @@ def jobs_new():
               method=['GET', 'POST'])
 def jobs_retry(job_id):
     if bottle.request.method == 'POST':
-        job = Job.objects.get(job_id=job_id)
+        job = Job.objects.exclude('tasks').get(job_id=job_id)
         if not job.is_finished:
             job.retry()
 
@@ -127,33 +170,29 @@ def jobs_retry(job_id):
 @bottle.get('/jobs/<job_id:re:[a-zA-Z0-9]+>/')
 @bottle.jinja2_view('job_details.html')
 def jobs_details(job_id):
-    job = Job.objects.get(job_id=job_id)
+    job = Job.objects.exclude('tasks').get(job_id=job_id)
     return {'job': job}
 
 
 @bottle.get('/jobs/<job_id:re:[a-zA-Z0-9]+>/tasks/')
 @bottle.jinja2_view('task_list.html')
 def task_list(job_id):
-    job = Job.objects.get(job_id=job_id)
-    return {'task_list': job.tasks, 'job_id': job_id}
+    tasks = Task.objects(job_id=job_id).order_by('id')
+    return {'task_list': tasks, 'job_id': job_id}
 
 
 @bottle.route('/jobs/<job_id:re:[a-zA-Z0-9]+>/tasks/<task_id:re:[a-zA-Z0-9]+>/actions/meta/',  # NOQA
               method=['GET', 'POST'])
 def task_meta_edit(job_id, task_id):
     task = Task.objects.get(job_id=job_id, md5=task_id)
-    meta_filename = '{0}/info.json'.format(task_id)
-    meta_bytes = utils.read_from_zip(task.zipball_path, meta_filename)
-    reader = codecs.getreader("utf-8")
-    meta = json.load(reader(meta_bytes))
+    meta = dict(task.get_info())
 
     if bottle.request.method == 'POST':
         form_data = bottle.request.forms.decode()
         form = MetaForm(form_data)
         if form.validate():
             meta.update(form.data)
-            replacements = {meta_filename: json.dumps(meta)}
-            utils.replace_in_zip(task.zipball_path, **replacements)
+            task.update_info(meta)
             return bottle.redirect('/jobs/{0}/tasks/'.format(job_id))
     else:
         form = MetaForm(**meta)
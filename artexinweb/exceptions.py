@@ -7,3 +7,13 @@ class ImproperlyConfigured(Exception):
 
 class TaskHandlingError(Exception):
     pass
+
+
+class TransientError(TaskHandlingError):
+    """Processing of a task failed for a reason which may be gone if it's
+    retried later."""
+    pass
+
+
+class UploadTooLarge(Exception):
+    pass
@@ -1,4 +1,6 @@
 # -*- coding: utf-8 -*-
+import zipfile
+
 from bottle import MultiDict
 
 from wtforms import fields
@@ -6,6 +8,7 @@ from wtforms import form
 from wtforms import validators
 
 from artexinweb import settings, utils
+from artexinweb.models import Job
 
 
 LICENSES = (
@@ -25,14 +28,18 @@ LICENSES = (
     ('ARL', "All rights reserved"),
     ('ON', "Other non-free license"),
 )
-LANGUAGE_CODES = [(lang_code, lang_label)
-                  for (lang_code, lang_label) in utils.collect_locales()
-                  if len(lang_code) < 3]
+
+
+def get_language_codes():
+    locales = utils.get_locales(settings.LOCALES_PATH)
+    return [(lang_code, lang_label) for (lang_code, lang_label) in locales
+            if len(lang_code) < 3]
 
 
 class MetaForm(form.Form):
     title = fields.StringField()
-    language = fields.SelectField(choices=LANGUAGE_CODES)
+    # choices are looked up upon instantiation of the form
+    language = fields.SelectField()
     license = fields.SelectField(choices=LICENSES)
     archive = fields.StringField()
     is_partner = fields.BooleanField(default=False)
@@ -40,6 +47,10 @@ class MetaForm(form.Form):
     is_sponsored = fields.BooleanField(default=False)
     keep_formatting = fields.BooleanField(default=False)
 
+    def __init__(self, *args, **kwargs):
+        super(MetaForm, self).__init__(*args, **kwargs)
+        self.language.choices = get_language_codes()
+
     def validate_partner(self, field):
         if self.is_partner.data and not field.data:
             raise validators.ValidationError("A partner must be specified")
@@ -56,31 +67,50 @@ class MetaForm(form.Form):
 
 
 def check_extension(form, field):
-    ext = utils.get_extension(field.data.filename)
-
     valid = settings.BOTTLE_CONFIG.get('web.allowed_upload_extensions',
                                        'zip').split(',')
 
-    if ext not in valid:
-        msg = "Only {0} files are allowed.".format(",".join(valid))
-        raise validators.StopValidation(msg)
+    for uploaded_file in field.data:
+        ext = utils.get_extension(uploaded_file.filename)
+        if ext not in valid:
+            msg = "Only {0} files are allowed.".format(",".join(valid))
+            raise validators.StopValidation(msg)
 
 
 def has_html_file(form, field):
     is_html_file = lambda fn: any(fn.endswith(ext) for ext in ('htm', 'html'))
-    files = utils.list_zipfile(field.data.file)
-    if not any(is_html_file(filename) for filename in files):
-        msg = "No HTML file found in: {0}".format(field.data.filename)
-        raise validators.StopValidation(msg)
-    # must seek to the beginning of file to save them properly
-    field.data.file.seek(0)
+    for uploaded_file in field.data:
+        try:
+            files = utils.list_zipfile(uploaded_file.file)
+        except zipfile.BadZipFile:
+            msg = "Invalid zip file: {0}".format(uploaded_file.filename)
+            raise validators.StopValidation(msg)
+
+        if not any(is_html_file(filename) for filename in files):
+            msg = "No HTML file found in: {0}".format(uploaded_file.filename)
+            raise validators.StopValidation(msg)
+        # must seek to the beginning of file to save them properly
+        uploaded_file.file.seek(0)
+
+
+class MultipleFileField(fields.FileField):
+    """File field holding all the files uploaded under it's name."""
+
+    def process_formdata(self, valuelist):
+        self.data = list(valuelist)
+
+
+class JobForm(MetaForm):
+    priority = fields.SelectField(choices=Job.PRIORITIES,
+                                  coerce=int,
+                                  default=Job.PRIORITY_NORMAL)
 
 
-class StandaloneJobForm(MetaForm):
+class StandaloneJobForm(JobForm):
     origin = fields.StringField(validators=[validators.URL(require_tld=True)])
-    files = fields.FileField(validators=[validators.InputRequired(),
-                                         check_extension,
-                                         has_html_file])
+    files = MultipleFileField(validators=[validators.InputRequired(),
+                                          check_extension,
+                                          has_html_file])
 
 
 class URLListField(fields.TextAreaField):
@@ -113,7 +143,7 @@ class URLListField(fields.TextAreaField):
                 raise validators.ValidationError("Invalid URL(s).")
 
 
-class FetchableJobForm(MetaForm):
+class FetchableJobForm(JobForm):
     urls = URLListField(validators=[validators.InputRequired()])
     javascript = fields.BooleanField(validators=[validators.optional()],
                                      default=True)
@@ -1,15 +1,42 @@
 # -*- coding: utf-8 -*-
+import contextlib
 import logging
+import random
+import threading
 import time
 
-from artexinweb.models import Job
+from concurrent import futures
+
+from artexinweb import exceptions, settings
+from artexinweb.models import Job, Task
 
 
 logger = logging.getLogger(__name__)
 
+# number of times the lease of a task is renewed within it's duration, so a
+# single delayed renewal doesn't make it expire
+LEASE_RENEWALS = 3
+
 
 class BaseJobHandler(object):
 
+    def get_concurrency(self):
+        """Return the maximum number of tasks of a single job that may be
+        processed in parallel, as set by the ``artexin.concurrency`` option.
+
+        :returns:  int
+        """
+        concurrency = settings.BOTTLE_CONFIG.get('artexin.concurrency', 1)
+        return max(int(concurrency), 1)
+
+    def order_tasks(self, tasks):
+        """Return the tasks of a job in the order they should be processed.
+
+        :param tasks:  List of ``Task`` model instances
+        :returns:      list of ``Task`` model instances
+        """
+        return tasks
+
     def is_valid_target(self, target):
         """Checks whether the passed in target is valid.
 
@@ -26,6 +53,61 @@ class BaseJobHandler(object):
         """
         return not task.is_finished
 
+    def is_transient_error(self, error):
+        """Checks whether the passed in error is caused by a temporary
+        condition, so the task may succeed if it's retried later.
+
+        :param error:  Exception instance or error message string
+        :returns:      bool
+        """
+        return isinstance(error, exceptions.TransientError)
+
+    def get_retry_delay(self, attempts):
+        """Return the number of seconds to wait before retrying a task. The
+        delay doubles with each attempt, from ``artexin.retry_delay`` up to
+        ``artexin.max_retry_delay`` seconds, and a random half of it is added
+        as jitter, so retries of tasks failing together are spread out.
+
+        :param attempts:  Number of times processing of the task was started
+        :returns:         float
+        """
+        config = settings.BOTTLE_CONFIG
+        base_delay = float(config.get('artexin.retry_delay', 30))
+        max_delay = Task.get_max_retry_delay()
+        delay = min(base_delay * 2 ** max(attempts - 1, 0), max_delay)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def fail_task(self, task, reason, error=None):
+        """Mark the task failed, unless the passed in error is transient and
+        the task has attempts left, in which case only the task is scheduled
+        to be processed again after a delay.
+
+        :param task:    ``Task`` model instance
+        :param reason:  Message stored in the notes of the task
+        :param error:   Optional exception instance or error message string
+        """
+        if (error is not None and
+                task.attempts < Task.get_max_attempts() and
+                self.is_transient_error(error)):
+            delay = self.get_retry_delay(task.attempts)
+            if task.mark_retrying(reason, expected=[Task.PROCESSING]):
+                msg = "Retrying task {0} in {1:.0f} seconds."
+                logger.warning(msg.format(task.target, delay))
+                try:
+                    job = Job.objects.exclude('tasks').get(job_id=task.job_id)
+                    job.schedule_tasks(Task.objects(id=task.id),
+                                       delay=delay,
+                                       status=Task.RETRYING)
+                except Exception:
+                    # a task waiting for a retry which never comes would hold
+                    # back the completion of it's job forever
+                    msg = "Scheduling retry of task {0} failed."
+                    logger.exception(msg.format(task.target))
+                else:
+                    return
+
+        task.mark_failed(reason)
+
     def handle_task(self, task, options):
         """Handle the task itself and return it's results.
 
@@ -45,68 +127,154 @@ class BaseJobHandler(object):
         """
         raise NotImplementedError()
 
-    def process_task(self, task, options):
+    @contextlib.contextmanager
+    def hold_lease(self, task):
+        """Context manager which keeps renewing the lease of the passed in task
+        from a background thread, for as long as the worker is processing it.
+
+        :param task:  ``Task`` model instance
+        """
+        interval = task.get_lease_duration().total_seconds() / LEASE_RENEWALS
+        stopped = threading.Event()
+
+        def heartbeat():
+            while not stopped.wait(interval):
+                try:
+                    task.renew_lease()
+                except Exception:
+                    msg = "Renewing lease of task {0} failed."
+                    logger.exception(msg.format(task.target))
+
+        thread = threading.Thread(target=heartbeat, daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stopped.set()
+            thread.join()
+
+    def process_task(self, task, options, status=None):
         """Dispatch task and later it's results to overridden methods of the
         subclassed ``BaseJobHandler``
 
         :param task:     ``Task`` model instance
         :param options:  Freeform dict holding the options of the parent job.
+        :param status:   Status the task is taken from, defaults to queued
         """
-        task.mark_processing()
+        # the task may already have been taken by another worker, as the
+        # tasks reclaimed from dead workers are sent to the workers again,
+        # and tasks waiting for a retry are taken only by their own messages
+        status = status or Task.QUEUED
+        if not task.mark_processing(expected=[status]):
+            msg = "Task {0} is already being processed. Skipping it."
+            logger.info(msg.format(task.target))
+            return
+
         start_time = time.process_time()
 
-        if not self.is_valid_target(task.target):
+        # targets validated upon creation of the task are not checked again
+        try:
+            is_valid = task.verified or self.is_valid_target(task.target)
+        except Exception as exc:
+            msg = "Task target {0} could not be validated."
+            logger.exception(msg.format(task.target))
+            reason = "Task target is inaccessible: {0}".format(str(exc))
+            self.fail_task(task, reason, exc)
+            return
+
+        if not is_valid:
             msg = "Task target {0} invalid. Marking it failed."
             logger.error(msg.format(task.target))
             task.mark_failed("Task target is invalid: {0}".format(task.target))
             return
 
         logger.info("Start processing of task {0}".format(task.target))
-        try:
-            result = self.handle_task(task, options)
-        except Exception as exc:
-            msg = "Unhandled exception while processing task: {0}"
-            logger.exception(msg.format(task.target))
-            task.mark_failed("Unhandled exception: {0}".format(str(exc)))
-        else:
-            elapsed_time = time.process_time() - start_time
-            msg = "Task {0} finished in {1} seconds."
-            logger.info(msg.format(task.target, elapsed_time))
-
+        with self.hold_lease(task):
             try:
-                self.handle_task_result(task, result, options)
+                result = self.handle_task(task, options)
             except Exception as exc:
-                msg = "Unhandled exception while processing task result: {0}"
+                msg = "Unhandled exception while processing task: {0}"
                 logger.exception(msg.format(task.target))
-                task.mark_failed("Unhandled exception: {0}".format(str(exc)))
+                reason = "Unhandled exception: {0}".format(str(exc))
+                self.fail_task(task, reason, exc)
             else:
-                msg = "Task result handling of {0} finished."
-                logger.info(msg.format(task.target))
+                elapsed_time = time.process_time() - start_time
+                msg = "Task {0} finished in {1} seconds."
+                logger.info(msg.format(task.target, elapsed_time))
+
+                try:
+                    self.handle_task_result(task, result, options)
+                except Exception as exc:
+                    msg = ("Unhandled exception while processing task "
+                           "result: {0}")
+                    logger.exception(msg.format(task.target))
+                    reason = "Unhandled exception: {0}".format(str(exc))
+                    self.fail_task(task, reason, exc)
+                else:
+                    msg = "Task result handling of {0} finished."
+                    logger.info(msg.format(task.target))
+
+    def run_task(self, job_data):
+        """Gets a single scheduled task of a job from the database and
+        processes it. The status of the parent job is updated once all of it's
+        tasks are done.
+
+        :param job_data:  Deserialized message(dict) from the redis queue.
+        """
+        job = Job.objects.exclude('tasks').get(job_id=job_data.get('id'))
+        task = Task.objects.get(id=job_data['task'])
+        job.mark_processing(expected=[Job.QUEUED])
+
+        if self.is_valid_task(task):
+            self.process_task(task, job.options, job_data.get('status'))
+        else:
+            logger.info("Skip processing of task: {0}".format(task.target))
+
+        if job.update_status():
+            msg = "Processing of {0} job: {1} completed with status: {2}."
+            logger.info(msg.format(job.job_type, job.job_id, job.status))
 
     def run(self, job_data):
         """Gets the scheduled job instance from the database and processes it.
+        Messages carrying a single task are processed by ``run_task``.
 
         :param job_data:  Deserialized message(dict) from the redis queue.
         """
-        job = Job.objects.get(job_id=job_data.get('id'))
+        if 'task' in job_data:
+            self.run_task(job_data)
+            return
+
+        job = Job.objects.exclude('tasks').get(job_id=job_data.get('id'))
         logger.info("Begin processing {0} job: {1}".format(job.job_type,
                                                            job.job_id))
         job.mark_processing()
 
-        for task in job.tasks:
-            if self.is_valid_task(task):
-                self.process_task(task, job.options)
-            else:
-                msg = "Skip processing of task: {0}".format(task.target)
-                logger.info(msg)
-
-        if any(task.is_failed for task in job.tasks):
-            msg = "Processing of {0} job: {1} erred.".format(job.job_type,
-                                                             job.job_id)
-            logger.info(msg)
-            job.mark_erred()
-        else:
-            msg = "Processing of {0} job: {1} finished.".format(job.job_type,
-                                                                job.job_id)
-            logger.info(msg)
-            job.mark_finished()
+        concurrency = self.get_concurrency()
+        with futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+            pending = dict()
+            for task in self.order_tasks(list(job.get_tasks())):
+                if self.is_valid_task(task):
+                    future = executor.submit(self.process_task,
+                                             task,
+                                             job.options)
+                    pending[future] = task
+                else:
+                    msg = "Skip processing of task: {0}".format(task.target)
+                    logger.info(msg)
+
+            for future in futures.as_completed(pending):
+                task = pending[future]
+                try:
+                    future.result()
+                except Exception as exc:
+                    # ``process_task`` handles errors of the task handlers
+                    # themselves, so this can only be a failure of the
+                    # processing machinery, which must not be lost in the pool
+                    msg = "Unhandled exception while processing task: {0}"
+                    logger.exception(msg.format(task.target))
+                    task.mark_failed("Unhandled exception: {0}".format(exc))
+
+        # the job is completed by the last of it's tasks waiting for a retry
+        if job.update_status(force=True):
+            msg = "Processing of {0} job: {1} completed with status: {2}."
+            logger.info(msg.format(job.job_type, job.job_id, job.status))
@@ -1,45 +1,285 @@
 # -*- coding: utf-8 -*-
+import datetime
+import http.client
+import json
 import logging
-import urllib
+import os
+import re
+import socket
+import urllib.error
 
 from artexin import pack
 from artexin import preprocessor_mappings
 
-from artexinweb import settings
+from artexinweb import exceptions, hosts, settings, utils
 from artexinweb.decorators import registered
 from artexinweb.handlers.base import BaseJobHandler
-from artexinweb.models import Job
+from artexinweb.models import Counter, Job, Task
 
 
 logger = logging.getLogger(__name__)
 
 
 class FetchableHandler(BaseJobHandler):
+    """Handler of jobs fetching URLs. Tasks are processed in an order which
+    interleaves their hosts, and each request to a host is held back until
+    the politeness rules of the host allow it, while the rest of the
+    processing of tasks runs freely. The rules are enforced within a single
+    worker process only."""
+
+    # politeness rules and keep-alive connections of hosts, shared by all the
+    # handler instances of the worker process
+    host_pool = hosts.HostPool()
+
+    # status codes of servers which do not implement the HEAD method
+    HEAD_REJECTED = (405, 501)
+
+    # status codes of responses, which may be different if the request is
+    # retried later
+    TRANSIENT_STATUSES = (408, 429, 500, 502, 503, 504)
+
+    # exceptions of network operations, which may succeed if retried later
+    TRANSIENT_EXCEPTIONS = (socket.timeout,
+                            TimeoutError,
+                            ConnectionError,
+                            http.client.BadStatusLine,
+                            http.client.IncompleteRead)
+
+    # errors reported by artexin as messages, which are worth retrying
+    TRANSIENT_MESSAGE = re.compile(
+        r'timed? ?out|connection (reset|refused|aborted)|temporar|'
+        r'\b(408|429|50[0234])\b',
+        re.IGNORECASE)
+
+    # names of counters keeping track of the efficiency of the dedup cache
+    CACHE_HITS = 'fetchable.cache.hits'
+    CACHE_MISSES = 'fetchable.cache.misses'
+    CACHE_EVICTIONS = 'fetchable.cache.evictions'
+
+    def get_validation_timeout(self):
+        timeout = settings.BOTTLE_CONFIG.get('artexin.validation_timeout', 10)
+        return float(timeout)
+
+    def __init__(self):
+        # cache validators of the latest versions of targets, obtained while
+        # validating them
+        self.validators = dict()
+
+    def probe(self, target, timeout, headers=None):
+        """Check whether the target is accessible, without downloading it's
+        contents. A HEAD request is made first, and only for servers that
+        reject it, a GET request limited to the first byte of the target.
+        Requests are made over the pooled connections of the target's host.
+
+        :param target:   URL string
+        :param timeout:  Timeout of the request in seconds
+        :param headers:  Optional dict of additional request headers
+        :returns:        tuple of response status and headers
+        """
+        headers = dict(headers or {})
+        (status, response_headers) = self.host_pool.request('HEAD',
+                                                            target,
+                                                            headers,
+                                                            timeout)
+        if status in self.HEAD_REJECTED:
+            headers = dict(headers, Range='bytes=0-0')
+            (status, response_headers) = self.host_pool.request('GET',
+                                                                target,
+                                                                headers,
+                                                                timeout)
+        return (status, response_headers)
 
     def is_valid_target(self, target):
         try:
-            urllib.request.urlopen(target)
-        except Exception:
+            (status, headers) = self.probe(target,
+                                           self.get_validation_timeout())
+        except Exception as exc:
+            if self.is_transient_error(exc):
+                raise
+
             msg = "URL: {0} not accessible.".format(target)
             logger.error(msg, exc_info=True)
             return False
-        else:
-            return True
+
+        if status in self.TRANSIENT_STATUSES:
+            msg = "URL: {0} responded with status {1}.".format(target, status)
+            raise exceptions.TransientError(msg)
+
+        if status >= 400:
+            msg = "URL: {0} responded with status {1}.".format(target, status)
+            logger.error(msg)
+            return False
+
+        self.validators[target] = (headers.get('ETag'),
+                                   headers.get('Last-Modified'))
+        return True
+
+    def is_transient_error(self, error):
+        """Errors are transient if they are caused by timeouts, dropped
+        connections or responses with the ``TRANSIENT_STATUSES``. Exceptions
+        raised while handling other exceptions are checked by their causes."""
+        if isinstance(error, str):
+            return self.TRANSIENT_MESSAGE.search(error) is not None
+
+        while isinstance(error, BaseException):
+            if isinstance(error, urllib.error.HTTPError):
+                return error.code in self.TRANSIENT_STATUSES
+
+            if isinstance(error, urllib.error.URLError):
+                error = error.reason
+                continue
+
+            if (isinstance(error, self.TRANSIENT_EXCEPTIONS) or
+                    super(FetchableHandler, self).is_transient_error(error)):
+                return True
+
+            error = error.__cause__ or error.__context__
+
+        return False
+
+    def order_tasks(self, tasks):
+        get_task_host = lambda task: hosts.get_host(task.target)
+        return hosts.interleave(tasks, key=get_task_host)
+
+    def get_fingerprint(self, target, options):
+        """Return a hash identifying the target together with all the options
+        which have an effect on the resulting zipball.
+
+        :param target:   URL string
+        :param options:  Freeform dict holding the options of the parent job.
+        :returns:        str: md5 hexdigest
+        """
+        meta = json.dumps(options.get('meta', {}), sort_keys=True)
+        return utils.hash_data(utils.normalize_url(target),
+                               bool(options.get('javascript', False)),
+                               bool(options.get('extract', False)),
+                               meta)
+
+    def get_cache_freshness(self):
+        freshness = settings.BOTTLE_CONFIG.get('artexin.cache_freshness', 0)
+        return datetime.timedelta(seconds=int(freshness))
+
+    def find_previous(self, task):
+        """Return the most recent finished task with the same fingerprint as
+        the passed in task.
+
+        :param task:  ``Task`` model instance with it's fingerprint set
+        :returns:     ``Task`` model instance or ``None``
+        """
+        return Task.objects(fingerprint=task.fingerprint,
+                            status=Task.FINISHED,
+                            id__ne=task.id).order_by('-timestamp').first()
+
+    def find_cached(self, task):
+        """Return the most recent finished task with the same fingerprint as
+        the passed in task, if it's still fresh and it's zipball exists.
+
+        :param task:  ``Task`` model instance with it's fingerprint set
+        :returns:     ``Task`` model instance or ``None``
+        """
+        freshness = self.get_cache_freshness()
+        if not freshness:
+            return None
+
+        cached = self.find_previous(task)
+        if cached is None:
+            Counter.increment(self.CACHE_MISSES)
+            return None
+
+        is_stale = cached.timestamp < datetime.datetime.utcnow() - freshness
+        if is_stale or not os.path.isfile(cached.zipball_path):
+            Counter.increment(self.CACHE_EVICTIONS)
+            return None
+
+        Counter.increment(self.CACHE_HITS)
+        return cached
+
+    def find_unmodified(self, task):
+        """Return the most recent finished task with the same fingerprint as
+        the passed in task, if the server confirms with a conditional request
+        that the target did not change since it was fetched. Otherwise the
+        validators of the passed in task are updated from the response.
+
+        :param task:  ``Task`` model instance with it's fingerprint set
+        :returns:     ``Task`` model instance or ``None``
+        """
+        previous = self.find_previous(task)
+        if previous is None or not (previous.etag or previous.last_modified):
+            return None
+
+        if not os.path.isfile(previous.zipball_path):
+            return None
+
+        headers = dict()
+        if previous.etag:
+            headers['If-None-Match'] = previous.etag
+        if previous.last_modified:
+            headers['If-Modified-Since'] = previous.last_modified
+
+        try:
+            (status, response_headers) = self.probe(
+                task.target,
+                self.get_validation_timeout(),
+                headers
+            )
+        except Exception:
+            msg = "Conditional request to {0} failed.".format(task.target)
+            logger.error(msg, exc_info=True)
+            return None
+
+        if status == 304:
+            return previous
+
+        task.etag = response_headers.get('ETag')
+        task.last_modified = response_headers.get('Last-Modified')
+        return None
+
+    def get_reused_result(self, task, timestamp):
+        """Return the results of a previously finished task, in the same format
+        as ``pack.collect`` does."""
+        return {'size': task.size,
+                'hash': task.md5,
+                'title': task.title,
+                'images': task.images,
+                'timestamp': timestamp}
 
     def handle_task(self, task, options):
-        return pack.collect(task.target,
-                            prep=preprocessor_mappings.get_preps(task.target),
-                            base_dir=settings.BOTTLE_CONFIG['artexin.out_dir'],
-                            javascript=options.get('javascript', False),
-                            do_extract=options.get('extract', False),
-                            meta=options.get('meta', {}))
+        task.fingerprint = self.get_fingerprint(task.target, options)
+        (task.etag, task.last_modified) = self.validators.pop(task.target,
+                                                              (None, None))
+        reusable = self.find_cached(task)
+        if reusable is not None:
+            timestamp = reusable.timestamp
+        else:
+            reusable = self.find_unmodified(task)
+            timestamp = datetime.datetime.utcnow()
+
+        if reusable is not None:
+            msg = "Reusing zipball {0} for {1}".format(reusable.md5,
+                                                       task.target)
+            logger.info(msg)
+            task.etag = reusable.etag
+            task.last_modified = reusable.last_modified
+            return self.get_reused_result(reusable, timestamp)
+
+        # artexin fetches the target itself, so only the host of the target
+        # is held for the duration of it
+        with self.host_pool.get(task.target).slot():
+            return pack.collect(
+                task.target,
+                prep=preprocessor_mappings.get_preps(task.target),
+                base_dir=settings.BOTTLE_CONFIG['artexin.out_dir'],
+                javascript=options.get('javascript', False),
+                do_extract=options.get('extract', False),
+                meta=options.get('meta', {})
+            )
 
     def handle_task_result(self, task, result, options):
         error = result.get('error')
         if error is not None:
             msg = "Error processing {0}: {1}".format(task.target, error)
             logger.error(msg)
-            task.mark_failed("ArtExIn error: {0}".format(error))
+            self.fail_task(task, "ArtExIn error: {0}".format(error), error)
             return
 
         task.size = result['size']
@@ -47,7 +287,10 @@ class FetchableHandler(BaseJobHandler):
         task.title = result['title']
         task.images = result['images']
         task.timestamp = result['timestamp']
+        task.info = task.read_zipball_info()
         task.mark_finished()  # implicit save
+        # the zipball may have been rewritten for other tasks sharing it
+        task.store_info(task.info)
 
 
 @registered(Job.FETCHABLE)
@@ -7,9 +7,12 @@ import os
 import shutil
 import tempfile
 import urllib
+import zipfile
 
 import bs4
 
+from lxml import etree
+
 from artexin import extract
 from artexin import pack
 
@@ -21,6 +24,17 @@ from artexinweb.models import Job
 
 logger = logging.getLogger(__name__)
 
+# extensions of the image types recognized by ``imghdr``
+IMAGE_EXTENSIONS = ('bmp', 'exr', 'gif', 'jpe', 'jpeg', 'jpg', 'pbm', 'pgm',
+                    'png', 'ppm', 'ras', 'rgb', 'tif', 'tiff', 'webp', 'xbm')
+NON_IMAGE_EXTENSIONS = ('css', 'eot', 'htm', 'html', 'ico', 'js', 'json',
+                        'otf', 'svg', 'ttf', 'txt', 'woff', 'woff2', 'xml')
+# number of bytes ``imghdr`` needs to recognize an image
+IMAGE_HEADER_SIZE = 32
+TITLE_CHUNK_SIZE = 16 * 1024
+# parser events signaling that no title is to be found anymore
+HEAD_OVER_EVENTS = (('end', 'head'), ('start', 'body'))
+
 
 class StandaloneHandler(BaseJobHandler):
 
@@ -58,6 +72,22 @@ class StandaloneHandler(BaseJobHandler):
             msg = "Unsupported extension: {0}".format(src_filepath)
             raise exceptions.TaskHandlingError(msg)
 
+    def get_extraction_workers(self, src_filepath):
+        """Return the number of threads the passed in archive should be
+        extracted with. Archives smaller than ``artexin.parallel_extraction``
+        bytes are extracted by a single thread, bigger ones by
+        ``artexin.extraction_workers`` threads.
+
+        :param src_filepath:  Full path of the to-be-extraced archive
+        :returns:             int
+        """
+        config = settings.BOTTLE_CONFIG
+        threshold = int(config.get('artexin.parallel_extraction', 0))
+        if not threshold or os.path.getsize(src_filepath) < threshold:
+            return 1
+
+        return max(int(config.get('artexin.extraction_workers', 1)), 1)
+
     def extract_target(self, src_filepath):
         """Extract the passed in archive to a temporary folder for further
         processing.
@@ -66,8 +96,9 @@ class StandaloneHandler(BaseJobHandler):
         :returns:             Full path to the destionation directory
         """
         extract = self.get_extractor(src_filepath)
+        workers = self.get_extraction_workers(src_filepath)
         temp_dir = tempfile.mkdtemp()
-        extract(src_filepath, temp_dir)
+        extract(src_filepath, temp_dir, workers=workers)
 
         return temp_dir
 
@@ -79,7 +110,7 @@ class StandaloneHandler(BaseJobHandler):
         meta['domain'] = urllib.parse.urlparse(options['origin']).netloc
         # pre-specified title has precedence
         meta['title'] = meta.get('title') or self.read_title(temp_dir)
-        meta['images'] = self.count_images(temp_dir)
+        (meta['images'], meta['image_size']) = self.count_images(task.target)
         meta['timestamp'] = datetime.datetime.utcnow()
 
         out_dir = settings.BOTTLE_CONFIG['artexin.out_dir']
@@ -111,34 +142,91 @@ class StandaloneHandler(BaseJobHandler):
             index_filename = html_files[0]
 
         html_path = os.path.join(target_dir, index_filename)
+        title = self.find_title(html_path)
+        if title:
+            return title
+
+        # fall back to parsing the whole document
         with codecs.open(html_path, 'r', 'utf-8') as html_file:
-            soup = bs4.BeautifulSoup(html_file.read())
+            soup = bs4.BeautifulSoup(html_file.read(), 'lxml')
 
         return extract.get_title(soup)
 
-    def count_images(self, target_dir):
-        """Return the number of recursively counted image files in the passed
-        in folder.
+    def find_title(self, html_path):
+        """Incrementally parse the passed in html file, until it's title is
+        found or the head section of the document is over, so the rest of the
+        document is never read.
+
+        :param html_path:  Full path to the html file
+        :returns:          str: title of html or ``None``
+        """
+        parser = etree.HTMLPullParser(events=('start', 'end'),
+                                      encoding='utf-8')
+        try:
+            with open(html_path, 'rb') as html_file:
+                for chunk in iter(lambda: html_file.read(TITLE_CHUNK_SIZE),
+                                  b''):
+                    parser.feed(chunk)
+                    for (event, element) in parser.read_events():
+                        if (event, element.tag) == ('end', 'title'):
+                            return (element.text or '').strip() or None
+                        if (event, element.tag) in HEAD_OVER_EVENTS:
+                            return None
+        except etree.LxmlError:
+            logger.exception("Title extraction failed: {0}".format(html_path))
+        return None
+
+    def is_image_member(self, zip_file, member):
+        """Check whether the passed in archive member is an image. The
+        extension of the member decides it, and only the header of members
+        with an unrecognized extension is read.
+
+        :param zip_file:  Open ``zipfile.ZipFile`` instance
+        :param member:    ``zipfile.ZipInfo`` instance of `zip_file`
+        :returns:         bool
+        """
+        ext = utils.get_extension(member.filename)
+        if ext in IMAGE_EXTENSIONS:
+            return True
+
+        if ext in NON_IMAGE_EXTENSIONS or not member.file_size:
+            return False
+
+        with zip_file.open(member) as member_file:
+            header = member_file.read(IMAGE_HEADER_SIZE)
+        return imghdr.what(None, h=header) is not None
+
+    def count_images(self, src_filepath):
+        """Return the number and the total size of the image files in the
+        passed in archive, using it's central directory, without extracting
+        any of the files.
 
-        :param target_dir:  Full path to the folder to-be-counted
-        :returns:           int
+        :param src_filepath:  Full path of the archive
+        :returns:             tuple of int: count and int: size in bytes
         """
-        is_image = lambda filename: imghdr.what(os.path.join(target_dir,
-                                                             filename))
+        count = size = 0
+        with zipfile.ZipFile(src_filepath) as zip_file:
+            for member in zip_file.infolist():
+                if member.filename.endswith('/'):
+                    continue
 
-        count = 0
-        for (dirpath, dirnames, filenames) in os.walk(target_dir):
-            count += len([fname for fname in filenames if is_image(fname)])
+                if self.is_image_member(zip_file, member):
+                    count += 1
+                    size += member.file_size
 
-        return count
+        return (count, size)
 
     def handle_task_result(self, task, result, options):
         task.size = result['size']
         task.md5 = result['hash']
         task.title = result['title']
         task.images = result['images']
+        task.image_size = result.get('image_size')
         task.timestamp = result['timestamp']
+        task.info = task.read_zipball_info()
         task.mark_finished()  # implicit save
+        # the zipball may have been rewritten for other tasks sharing it
+        task.store_info(task.info)
 
 
 @registered(Job.STANDALONE)
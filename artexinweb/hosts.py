@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+import contextlib
+import http.client
+import itertools
+import threading
+import time
+import urllib.parse
+
+from artexinweb import settings
+
+
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+MAX_REDIRECTS = 5
+
+# some servers reject requests without a user agent
+DEFAULT_USER_AGENT = ('Mozilla/5.0 (compatible; artexinweb; '
+                      '+https://github.com/Outernet-Project/artexinweb)')
+
+# errors of reused connections which were closed by the server while idle,
+# raised before any response arrives
+STALE_CONNECTION_ERRORS = (http.client.BadStatusLine, ConnectionError)
+
+
+def get_host(url):
+    return urllib.parse.urlsplit(url).netloc.lower()
+
+
+def interleave(items, key):
+    """Reorder the passed in items so that consecutive items belong to
+    different groups as long as possible, while keeping the original order of
+    the items within each group.
+
+    :param items:  Iterable of items
+    :param key:    Function returning the group of an item
+    :returns:      list of items
+    """
+    groups = dict()
+    for item in items:
+        groups.setdefault(key(item), []).append(item)
+
+    rounds = itertools.zip_longest(*groups.values())
+    return [item for item in itertools.chain(*rounds) if item is not None]
+
+
+class Host(object):
+    """Enforces the politeness rules towards a single host, and keeps it's idle
+    keep-alive connections for reuse."""
+
+    connection_classes = {
+        'http': http.client.HTTPConnection,
+        'https': http.client.HTTPSConnection,
+    }
+
+    def __init__(self, scheme, netloc, concurrency, delay,
+                 user_agent=DEFAULT_USER_AGENT):
+        self.scheme = scheme
+        self.netloc = netloc
+        self.delay = delay
+        self.user_agent = user_agent
+        self.semaphore = threading.BoundedSemaphore(concurrency)
+        # held while waiting for the delay between accesses, so it's separate
+        # from the lock of the idle connections
+        self.access_lock = threading.Lock()
+        self.lock = threading.Lock()
+        self.last_access = None
+        self.idle_connections = []
+
+    @contextlib.contextmanager
+    def slot(self):
+        """Context manager which blocks until the host may be accessed again,
+        respecting both the concurrency limit and the minimum delay between
+        accesses."""
+        with self.semaphore:
+            with self.access_lock:
+                if self.last_access is not None:
+                    wait = self.last_access + self.delay - time.monotonic()
+                    if wait > 0:
+                        time.sleep(wait)
+                self.last_access = time.monotonic()
+            yield
+
+    def create_connection(self, timeout):
+        connection_cls = self.connection_classes[self.scheme]
+        return connection_cls(self.netloc, timeout=timeout)
+
+    def acquire_connection(self, timeout):
+        """Return an idle connection, or a new one if there are none.
+
+        :returns:  tuple of the connection and whether it's reused
+        """
+        with self.lock:
+            if self.idle_connections:
+                connection = self.idle_connections.pop()
+                # the timeout of a connection is applied to it's socket only
+                # when it's connected, which reused connections already are
+                connection.timeout = timeout
+                if connection.sock is not None:
+                    connection.sock.settimeout(timeout)
+                return (connection, True)
+
+        return (self.create_connection(timeout), False)
+
+    def release_connection(self, connection):
+        with self.lock:
+            self.idle_connections.append(connection)
+
+    def send(self, connection, method, path, headers):
+        try:
+            connection.request(method, path, headers=headers)
+            return connection.getresponse()
+        except Exception:
+            connection.close()
+            raise
+
+    def request(self, method, path, headers, timeout):
+        """Perform a request over a pooled connection. If a reused connection
+        turns out to be closed by the server, the request is repeated once
+        over a new connection. The response body is consumed, so the
+        connection can be reused, unless the server ignored the requested
+        range, in which case the connection is closed instead of reading the
+        whole target.
+
+        :returns:  tuple of response status and headers
+        """
+        headers = dict(headers)
+        headers.setdefault('User-Agent', self.user_agent)
+        (connection, is_reused) = self.acquire_connection(timeout)
+        try:
+            response = self.send(connection, method, path, headers)
+        except STALE_CONNECTION_ERRORS:
+            if not is_reused:
+                raise
+            connection = self.create_connection(timeout)
+            response = self.send(connection, method, path, headers)
+
+        if 'Range' in headers and response.status != 206:
+            connection.close()
+            return (response.status, response.msg)
+
+        try:
+            response.read()
+        except Exception:
+            connection.close()
+            raise
+
+        if response.will_close:
+            connection.close()
+        else:
+            self.release_connection(connection)
+
+        return (response.status, response.msg)
+
+
+class HostPool(object):
+    """Registry of ``Host`` instances, shared by all the threads of a worker
+    process. The politeness rules are set by the ``artexin.host_concurrency``
+    and ``artexin.host_delay`` options, and the user agent sent to the hosts
+    by the ``artexin.user_agent`` option."""
+
+    def __init__(self):
+        self.hosts = dict()
+        self.lock = threading.Lock()
+
+    def get(self, url):
+        """Return the ``Host`` instance for the host of the passed in URL."""
+        parsed = urllib.parse.urlsplit(url)
+        scheme = parsed.scheme.lower()
+        netloc = parsed.netloc.lower()
+        with self.lock:
+            try:
+                return self.hosts[(scheme, netloc)]
+            except KeyError:
+                config = settings.BOTTLE_CONFIG
+                concurrency = int(config.get('artexin.host_concurrency', 2))
+                delay = float(config.get('artexin.host_delay', 0))
+                user_agent = config.get('artexin.user_agent',
+                                        DEFAULT_USER_AGENT)
+                host = Host(scheme,
+                            netloc,
+                            max(concurrency, 1),
+                            delay,
+                            user_agent=user_agent)
+                self.hosts[(scheme, netloc)] = host
+                return host
+
+    def request(self, method, url, headers, timeout):
+        """Perform a request to the passed in URL, following redirects. Each
+        request waits for the politeness rules of the host it's sent to,
+        including the hosts the target redirects to.
+
+        :param method:   HTTP method string
+        :param url:      URL string
+        :param headers:  Dict of request headers
+        :param timeout:  Timeout of the request in seconds
+        :returns:        tuple of response status and headers
+        """
+        for _ in range(MAX_REDIRECTS + 1):
+            parsed = urllib.parse.urlsplit(url)
+            path = urllib.parse.urlunsplit(('', '', parsed.path or '/',
+                                            parsed.query, ''))
+            host = self.get(url)
+            with host.slot():
+                (status, response_headers) = host.request(method,
+                                                          path,
+                                                          headers,
+                                                          timeout)
+            location = response_headers.get('Location')
+            if status not in REDIRECT_CODES or not location:
+                return (status, response_headers)
+
+            url = urllib.parse.urljoin(url, location)
+
+        raise http.client.HTTPException("Too many redirects: {0}".format(url))
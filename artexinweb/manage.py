@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""Management commands, meant to be run at deployment time.
+
+Usage::
+
+    python -m artexinweb.manage ensure_indexes
+    python -m artexinweb.manage check_indexes
+    python -m artexinweb.manage save_locales
+    python -m artexinweb.manage reclaim_tasks
+"""
+import argparse
+import logging
+import logging.config
+import sys
+
+import mongoengine
+
+from artexinweb import reaper, settings, utils
+from artexinweb.models import Job, Task
+
+
+logger = logging.getLogger(__name__)
+
+MODELS = (Job, Task)
+
+
+def ensure_indexes():
+    """Create all the indexes declared on the models, which do not exist yet.
+
+    :returns:  int: exit code
+    """
+    for model in MODELS:
+        logger.info("Ensuring indexes of {0}".format(model.__name__))
+        model.ensure_indexes()
+
+    return 0
+
+
+def check_indexes():
+    """Verify that all the indexes declared on the models exist.
+
+    :returns:  int: exit code
+    """
+    exit_code = 0
+    for model in MODELS:
+        missing = model.compare_indexes()['missing']
+        if missing:
+            msg = "Missing indexes of {0}: {1}".format(model.__name__, missing)
+            logger.error(msg)
+            exit_code = 1
+
+    return exit_code
+
+
+def save_locales():
+    """Precompute the list of languages offered by the forms, so the web
+    processes don't have to collect them from Babel.
+
+    :returns:  int: exit code
+    """
+    logger.info("Saving locales to {0}".format(settings.LOCALES_PATH))
+    utils.save_locales(settings.LOCALES_PATH)
+    return 0
+
+
+def reclaim_tasks():
+    """Reclaim the tasks of dead workers right away, instead of waiting for
+    the workers to do it periodically.
+
+    :returns:  int: exit code
+    """
+    (requeued, failed) = reaper.reclaim()
+    msg = "Requeued {0} and failed {1} task(s) with expired leases."
+    logger.info(msg.format(requeued, failed))
+    return 0
+
+
+COMMANDS = {
+    'ensure_indexes': ensure_indexes,
+    'check_indexes': check_indexes,
+    'save_locales': save_locales,
+    'reclaim_tasks': reclaim_tasks,
+}
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="ArtExInWeb management")
+    parser.add_argument('command', choices=sorted(COMMANDS))
+    options = parser.parse_args(args)
+
+    logging.config.dictConfig(settings.LOGGING)
+    mongoengine.connect('', host=settings.BOTTLE_CONFIG['database.url'])
+
+    return COMMANDS[options.command]()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,2 +1,3 @@
 # -*- coding: utf-8 -*-
 from .jobs import *
+from .stats import *
@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
+import codecs
 import datetime
+import json
 import os
 
 import mongoengine
@@ -8,24 +10,85 @@ from artexinweb import worker, utils, settings
 
 
 MD5_LENGTH = 32
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+class StatusMixin(object):
+    """Provides atomic status transitions for documents having a ``status``
+    and an ``updated`` field."""
+
+    def transition(self, status, expected=None, increments=None, **fields):
+        """Atomically set the status and the passed in fields of the document,
+        without saving any other field of it. If ``expected`` is specified,
+        the update is performed only if the stored status is one of those, so
+        concurrent workers cannot overwrite each other's transitions.
+
+        :param status:      The new status
+        :param expected:    Optional iterable of the allowed current statuses
+        :param increments:  Optional dict mapping names of numeric fields to
+                            the amounts they are incremented by in the same
+                            update, reloaded once it was performed
+        :param fields:      Additional fields to be set along with the status
+        :returns:           bool: whether the update was performed
+        """
+        fields['status'] = status
+        fields['updated'] = datetime.datetime.utcnow()
+        for (name, value) in fields.items():
+            if value is not None:
+                self._fields[name].validate(value)
+
+        query = {'pk': self.pk}
+        if expected is not None:
+            query['status__in'] = list(expected)
+
+        updates = dict(('set__{0}'.format(name), value)
+                       for (name, value) in fields.items())
+        increments = increments or dict()
+        updates.update(('inc__{0}'.format(name), amount)
+                       for (name, amount) in increments.items())
+        if not type(self).objects(**query).update_one(**updates):
+            return False
+
+        for (name, value) in fields.items():
+            setattr(self, name, value)
+
+        if increments:
+            # the stored values may have been changed by other workers too
+            self.reload(*increments)
+
+        return True
 
 
-class Task(mongoengine.Document):
+class Task(StatusMixin, mongoengine.Document):
     """Tasks are the smallest unit of work, which contain an exact target that
     needs to be processed."""
     QUEUED = "QUEUED"
     PROCESSING = "PROCESSING"
+    RETRYING = "RETRYING"
     FAILED = "FAILED"
     FINISHED = "FINISHED"
     STATUSES = (
         (QUEUED, "Queued"),
         (PROCESSING, "Processing"),
+        (RETRYING, "Waiting for retry"),
         (FAILED, "Failed"),
         (FINISHED, "Finished"),
     )
 
+    # fields set by the task handlers, stored when the task is finished
+    RESULT_FIELDS = ('size', 'md5', 'title', 'images', 'image_size',
+                     'timestamp', 'fingerprint', 'etag', 'last_modified',
+                     'info')
+
     meta = {
-        'indexes': ['md5']
+        'indexes': ['md5',
+                    ('job_id', 'md5'),
+                    ('job_id', 'status'),
+                    ('status', 'updated'),
+                    ('status', 'lease_expires'),
+                    ('fingerprint', 'status', '-timestamp')],
+        # indexes are created on deployment, see ``artexinweb.manage``
+        'auto_create_index': False
     }
 
     job_id = mongoengine.StringField(required=True,
@@ -42,11 +105,36 @@ class Task(mongoengine.Document):
                                 help_text="Size of page in bytes.")
     images = mongoengine.IntField(min_value=0,
                                   help_text="Number of images on the page.")
+    image_size = mongoengine.IntField(min_value=0,
+                                      help_text="Total size of images in "
+                                                "bytes.")
     timestamp = mongoengine.DateTimeField(help_text="End time of task.")
     status = mongoengine.StringField(choices=STATUSES,
                                      default=QUEUED,
                                      help_text="Job status.")
     notes = mongoengine.StringField(help_text="Arbitary information")
+    updated = mongoengine.DateTimeField(help_text="Time of last status update")
+    fingerprint = mongoengine.StringField(max_length=MD5_LENGTH,
+                                          min_length=MD5_LENGTH,
+                                          help_text="Hash of target+options.")
+    etag = mongoengine.StringField(help_text="ETag of the fetched target.")
+    last_modified = mongoengine.StringField(help_text="Last-Modified of the "
+                                                      "fetched target.")
+    info = mongoengine.DictField(help_text="Copy of the info.json contained "
+                                           "in the zipball.")
+    source_md5 = mongoengine.StringField(max_length=MD5_LENGTH,
+                                         help_text="MD5 hash of the uploaded "
+                                                   "target file.")
+    verified = mongoengine.BooleanField(default=False,
+                                        help_text="Whether the target was "
+                                                  "validated upon creation.")
+    lease_expires = mongoengine.DateTimeField(help_text="Time until the "
+                                                        "processing worker "
+                                                        "holds the task.")
+    attempts = mongoengine.IntField(min_value=0,
+                                    default=0,
+                                    help_text="Number of times processing "
+                                              "of the task was started.")
 
     @classmethod
     def create(cls, job_id, target):
@@ -60,6 +148,30 @@ class Task(mongoengine.Document):
         task.save()
         return task
 
+    @classmethod
+    def create_many(cls, job_id, targets, task_fields=None):
+        """Create new tasks for all the passed in targets with a single batched
+        insert.
+
+        :param job_id:       The string ID of the parent job instance
+        :param targets:      Iterable containing URLs or filesystem paths
+        :param task_fields:  Optional dict mapping targets to dicts of
+                             additional fields of their tasks
+        :returns:            list of ``Task`` instances
+        """
+        task_fields = task_fields or dict()
+        tasks = [cls(job_id=job_id,
+                     target=target,
+                     **task_fields.get(target, {}))
+                 for target in targets]
+        if not tasks:
+            return []
+
+        for task in tasks:
+            task.validate()
+
+        return cls.objects.insert(tasks)
+
     @property
     def is_queued(self):
         return self.status == self.QUEUED
@@ -72,6 +184,10 @@ class Task(mongoengine.Document):
     def is_finished(self):
         return self.status == self.FINISHED
 
+    @property
+    def is_retrying(self):
+        return self.status == self.RETRYING
+
     @property
     def is_failed(self):
         return self.status == self.FAILED
@@ -87,26 +203,152 @@ class Task(mongoengine.Document):
         filename = '{0}.zip'.format(self.md5)
         return os.path.join(zipball_root, filename)
 
-    def mark_queued(self):
-        self.status = self.QUEUED
-        self.save()
+    @property
+    def info_filename(self):
+        return '{0}/info.json'.format(self.md5)
+
+    def read_zipball_info(self):
+        """Read and parse the info.json file from the zipball of the task."""
+        info_bytes = utils.read_from_zip(self.zipball_path, self.info_filename)
+        reader = codecs.getreader("utf-8")
+        return json.load(reader(info_bytes))
+
+    def get_info(self):
+        """Return the metadata of the task from the database. Tasks finished
+        before the metadata was stored along with them have it read from their
+        zipball once, and stored for subsequent reads."""
+        if not self.info:
+            self.store_info(self.read_zipball_info())
+        return self.info
+
+    def store_info(self, info):
+        """Store the passed in metadata in the database, on all the tasks
+        sharing the zipball of the task, so their copies stay in sync with
+        it.
+
+        :param info:  dict containing the complete metadata
+        """
+        type(self).objects(md5=self.md5).update(set__info=info)
+        self.info = info
+
+    def update_info(self, info):
+        """Write the passed in metadata into the zipball of the task, and
+        keep the copies stored in the database in sync with it.
+
+        :param info:  dict containing the complete metadata
+        """
+        replacements = {self.info_filename: json.dumps(info)}
+        utils.replace_in_zip(self.zipball_path, **replacements)
+        self.store_info(info)
+
+    @classmethod
+    def count_statuses(cls, job_id):
+        """Count the tasks of a job by their statuses, with a single
+        aggregation query.
+
+        :param job_id:  The string ID of the parent job instance
+        :returns:       dict mapping statuses to the number of tasks
+        """
+        pipeline = [{'$match': {'job_id': job_id}},
+                    {'$group': {'_id': '$status', 'count': {'$sum': 1}}}]
+        results = cls._get_collection().aggregate(pipeline)
+        return dict((result['_id'], result['count']) for result in results)
+
+    def mark_queued(self, expected=None):
+        return self.transition(self.QUEUED, expected)
+
+    @classmethod
+    def get_lease_duration(cls):
+        """Return the number of seconds for which a worker holds a task it
+        started processing, as set by the ``artexin.lease_duration`` option.
+        The lease is renewed while the worker is alive, so tasks of workers
+        which were killed are reclaimed once their leases expire.
+
+        :returns:  ``datetime.timedelta``
+        """
+        seconds = settings.BOTTLE_CONFIG.get('artexin.lease_duration', 300)
+        return datetime.timedelta(seconds=int(seconds))
+
+    @classmethod
+    def get_max_attempts(cls):
+        """Return the number of times processing of a task may be started,
+        either by retrying it or by reclaiming it from a dead worker, as set by
+        the ``artexin.max_attempts`` option.
+
+        :returns:  int
+        """
+        max_attempts = settings.BOTTLE_CONFIG.get('artexin.max_attempts', 3)
+        return max(int(max_attempts), 1)
+
+    @classmethod
+    def get_max_retry_delay(cls):
+        """Return the maximum number of seconds a task waits for a retry, as
+        set by the ``artexin.max_retry_delay`` option.
+
+        :returns:  float
+        """
+        return float(settings.BOTTLE_CONFIG.get('artexin.max_retry_delay',
+                                                3600))
+
+    @classmethod
+    def get_lost_retries(cls, now=None):
+        """Return the tasks which are waiting for a retry for longer than the
+        maximum retry delay and a lease, so the delayed messages of their
+        retries must have been lost.
+
+        :param now:  Point in time the waiting is compared to, defaults to now
+        :returns:    ``QuerySet`` of ``Task`` instances
+        """
+        now = now or datetime.datetime.utcnow()
+        max_delay = datetime.timedelta(seconds=cls.get_max_retry_delay())
+        waiting_since = now - max_delay - cls.get_lease_duration()
+        return cls.objects(status=cls.RETRYING, updated__lt=waiting_since)
+
+    @classmethod
+    def get_expired(cls, now=None):
+        """Return the tasks which are being processed, but their leases
+        expired.
+
+        :param now:  Point in time the leases are compared to, defaults to now
+        :returns:    ``QuerySet`` of ``Task`` instances
+        """
+        now = now or datetime.datetime.utcnow()
+        return cls.objects(status=cls.PROCESSING, lease_expires__lt=now)
+
+    def renew_lease(self):
+        """Extend the lease of the task, as long as it's still being
+        processed.
+
+        :returns:  bool: whether the lease was renewed
+        """
+        lease_expires = datetime.datetime.utcnow() + self.get_lease_duration()
+        query = type(self).objects(pk=self.pk, status=self.PROCESSING)
+        if not query.update_one(set__lease_expires=lease_expires):
+            return False
+
+        self.lease_expires = lease_expires
+        return True
+
+    def mark_processing(self, expected=None):
+        lease_expires = datetime.datetime.utcnow() + self.get_lease_duration()
+        return self.transition(self.PROCESSING,
+                               expected,
+                               increments={'attempts': 1},
+                               lease_expires=lease_expires)
 
-    def mark_processing(self):
-        self.status = self.PROCESSING
-        self.save()
+    def mark_retrying(self, reason, expected=None):
+        return self.transition(self.RETRYING, expected, notes=reason)
 
-    def mark_failed(self, reason):
-        self.status = self.FAILED
-        self.notes = reason
-        self.save()
+    def mark_failed(self, reason, expected=None):
+        return self.transition(self.FAILED, expected, notes=reason)
 
-    def mark_finished(self):
-        self.status = self.FINISHED
-        self.notes = ''
-        self.save()
+    def mark_finished(self, expected=None):
+        results = dict((name, getattr(self, name))
+                       for name in self.RESULT_FIELDS)
+        return self.transition(self.FINISHED, expected, notes='', **results)
 
 
-class Job(mongoengine.Document):
+class Job(StatusMixin, mongoengine.Document):
     """Jobs are container units, holding one or more tasks."""
     QUEUED = "QUEUED"
     PROCESSING = "PROCESSING"
@@ -126,6 +368,33 @@ class Job(mongoengine.Document):
         (FETCHABLE, "Fetchable")
     )
 
+    # priorities, jobs of higher priorities are processed first
+    PRIORITY_LOW = -1
+    PRIORITY_NORMAL = 0
+    PRIORITY_HIGH = 1
+    PRIORITY_URGENT = 2
+    PRIORITIES = (
+        (PRIORITY_LOW, "Low"),
+        (PRIORITY_NORMAL, "Normal"),
+        (PRIORITY_HIGH, "High"),
+        (PRIORITY_URGENT, "Urgent"),
+    )
+
+    # fields loaded for job listings
+    LIST_FIELDS = ('job_id', 'status', 'scheduled', 'updated')
+
+    # dispatch modes, chosen by the ``artexin.dispatch`` option
+    DISPATCH_JOB = "job"
+    DISPATCH_TASK = "task"
+
+    meta = {
+        # the listing is sorted by both the update time and the job_id
+        'indexes': [('updated', 'job_id'),
+                    ('status', 'updated', 'job_id')],
+        # indexes are created on deployment, see ``artexinweb.manage``
+        'auto_create_index': False
+    }
+
     job_id = mongoengine.StringField(required=True,
                                      primary_key=True,
                                      max_length=MD5_LENGTH,
@@ -145,6 +414,9 @@ class Job(mongoengine.Document):
                                   required=True,
                                   help_text="References to subtasks of job.")
     options = mongoengine.DictField(help_text="Additional(free-form) options.")
+    priority = mongoengine.IntField(choices=PRIORITIES,
+                                    default=PRIORITY_NORMAL,
+                                    help_text="Processing priority.")
 
     @property
     def is_queued(self):
@@ -172,6 +444,64 @@ class Job(mongoengine.Document):
 
         return super(Job, self).save(*args, **kwargs)
 
+    @property
+    def cursor(self):
+        """Cursor pointing to the job in the listing of jobs. Mongo stores
+        datetimes with millisecond precision, so they are represented in
+        milliseconds."""
+        delta = self.updated - EPOCH
+        milliseconds = delta // datetime.timedelta(milliseconds=1)
+        return '{0}.{1}'.format(milliseconds, self.job_id)
+
+    @classmethod
+    def parse_cursor(cls, cursor):
+        """Return the update time and job_id stored in the passed in cursor.
+
+        :param cursor:  Cursor string, as returned by ``Job.cursor``
+        :returns:       tuple of datetime and job_id
+        :raises:        ValueError if the cursor is malformed
+        """
+        (milliseconds, job_id) = cursor.split('.', 1)
+        try:
+            delta = datetime.timedelta(milliseconds=int(milliseconds))
+            updated = EPOCH + delta
+        except (ValueError, OverflowError):
+            raise ValueError("Invalid time in cursor: {0}".format(cursor))
+        if len(job_id) != MD5_LENGTH or not job_id.isalnum():
+            raise ValueError("Invalid job_id in cursor: {0}".format(cursor))
+
+        return (updated, job_id)
+
+    @classmethod
+    def get_page(cls, status=None, cursor=None, page_size=50):
+        """Return a page of jobs, starting with the most recently updated one.
+        Only the fields needed for listing the jobs are loaded. Instead of
+        skipping the preceding jobs, pages are addressed by the cursor of the
+        last job of the preceding page.
+
+        :param status:     Optionally, list only jobs with this status
+        :param cursor:     Cursor of the last job of the preceding page
+        :param page_size:  Maximum number of jobs on a page
+        :returns:          tuple of list of jobs and the cursor of the next
+                           page, or ``None`` if there are no more jobs
+        """
+        jobs = cls.objects.only(*cls.LIST_FIELDS)
+        if status:
+            jobs = jobs.filter(status=status)
+
+        if cursor:
+            (updated, job_id) = cls.parse_cursor(cursor)
+            jobs = jobs.filter(mongoengine.Q(updated__lt=updated) |
+                               mongoengine.Q(updated=updated,
+                                             job_id__lt=job_id))
+
+        jobs = list(jobs.order_by('-updated', '-job_id').limit(page_size + 1))
+        if len(jobs) > page_size:
+            jobs = jobs[:page_size]
+            return (jobs, jobs[-1].cursor)
+
+        return (jobs, None)
+
     @classmethod
     def generate_id(cls, *args):
         """Generate a unique job_id by feeding the hash object with the passed
@@ -179,24 +509,34 @@ class Job(mongoengine.Document):
         return utils.hash_data(*args)
 
     @classmethod
-    def create(cls, targets, job_type, **kwargs):
+    def create(cls, targets, job_type, task_fields=None, priority=None,
+               **kwargs):
         """Create a new job from the passed in list of target(s).
 
-        :param targets:  Iterable containing URLs or filesystem paths
-        :param kwargs:   All kwargs are stored as additional options of the job
-        :returns:       ``Job`` instance
+        :param targets:      Iterable containing URLs or filesystem paths
+        :param task_fields:  Optional dict mapping targets to dicts of
+                             additional fields of their tasks
+        :param priority:     Optional priority, one of ``Job.PRIORITIES``
+        :param kwargs:       All kwargs are stored as additional options of
+                             the job
+        :returns:            ``Job`` instance
         """
+        if priority is None:
+            priority = cls.PRIORITY_NORMAL
+
         creation_time = datetime.datetime.utcnow()
+        targets = list(targets)
 
         # generate job_id from the current time + the passed in targets
-        job_id = cls.generate_id(creation_time, *list(targets))
+        job_id = cls.generate_id(creation_time, *targets)
 
         job = cls(job_id=job_id,
                   job_type=job_type,
                   scheduled=creation_time,
+                  priority=priority,
                   options=kwargs)
 
-        job.tasks = [Task.create(job_id, t) for t in targets]
+        job.tasks = Task.create_many(job_id, targets, task_fields)
         job.save()
         job.schedule()
 
@@ -210,27 +550,134 @@ class Job(mongoengine.Document):
         codes, _ = zip(*cls.TYPES)
         return job_type in codes
 
+    @classmethod
+    def get_dispatch_mode(cls):
+        """Return the configured dispatch mode, which determines whether a job
+        is sent to the background workers as a whole, or each of it's tasks
+        is sent as a separate message."""
+        return settings.BOTTLE_CONFIG.get('artexin.dispatch', cls.DISPATCH_JOB)
+
+    def get_queue_name(self):
+        """Return the name of the queue the job is sent to, chosen by the kind
+        of work it needs, so slow javascript rendering doesn't hold back the
+        other jobs."""
+        if self.job_type == self.STANDALONE:
+            return settings.QUEUE_STANDALONE
+
+        if self.options.get('javascript'):
+            return settings.QUEUE_FETCHABLE_JS
+
+        return settings.QUEUE_FETCHABLE_STATIC
+
     def schedule(self):
-        """Schedule the job for processing by a background worker."""
-        worker.dispatch({'type': self.job_type, 'id': self.job_id})
+        """Schedule the job for processing by a background worker. In task
+        dispatch mode, all the unfinished tasks are scheduled individually, so
+        they can be spread among all the available workers."""
+        if self.get_dispatch_mode() == self.DISPATCH_TASK:
+            unfinished = self.get_tasks().filter(status__ne=Task.FINISHED)
+            self.schedule_tasks(unfinished)
+        else:
+            worker.dispatch({'type': self.job_type, 'id': self.job_id},
+                            self.get_queue_name(),
+                            self.priority)
+
+    def schedule_tasks(self, tasks, delay=None, status=None):
+        """Schedule the passed in tasks of the job for processing by the
+        background workers, each of them sent as a separate message. Workers
+        take only queued tasks, unless the messages specify another status,
+        so a task is processed only by the message meant for it's current
+        state.
+
+        :param tasks:   ``QuerySet`` of ``Task`` instances of the job
+        :param delay:   Optional number of seconds to wait before sending them
+        :param status:  Optional status the tasks are taken from instead
+        """
+        messages = [{'type': self.job_type,
+                     'id': self.job_id,
+                     'task': str(task.id)}
+                    for task in tasks.only('id')]
+        if status is not None:
+            for message in messages:
+                message['status'] = status
+
+        worker.dispatch_many(messages,
+                             self.get_queue_name(),
+                             self.priority,
+                             delay=delay)
 
     def retry(self):
-        """Retry a previously failed job."""
+        """Retry a previously failed job. It's failed tasks and the ones
+        waiting for a retry are queued again, and the attempts of all it's
+        unfinished tasks are reset, so they can be reclaimed again if their
+        workers die. Tasks still being processed are left to their workers,
+        or to the reclaiming of their leases."""
+        unfinished = self.get_tasks().filter(status__ne=Task.FINISHED)
+        unfinished.update(set__attempts=0)
+        stopped = self.get_tasks().filter(status__in=[Task.FAILED,
+                                                      Task.RETRYING])
+        stopped.update(set__status=Task.QUEUED,
+                       set__updated=datetime.datetime.utcnow())
         self.mark_queued()
         self.schedule()
 
-    def mark_queued(self):
-        self.status = self.QUEUED
-        self.save()
+    @classmethod
+    def get_stalled(cls, now=None):
+        """Return the jobs which are being processed, but none of their tasks
+        were taken by a worker for longer than a lease, so the worker which
+        received the job may have died before starting any of them. Only the
+        fields needed for scheduling the jobs are loaded.
+
+        :param now:  Point in time the updates are compared to, defaults to now
+        :returns:    list of ``Job`` instances
+        """
+        now = now or datetime.datetime.utcnow()
+        updated_before = now - Task.get_lease_duration()
+        jobs = cls.objects(status=cls.PROCESSING,
+                           updated__lt=updated_before).exclude('tasks')
+        jobs = dict((job.job_id, job) for job in jobs)
+        # a single query for the jobs which have any of their tasks leased
+        leased = Task.objects(job_id__in=list(jobs),
+                              status=Task.PROCESSING).distinct('job_id')
+        return [job for (job_id, job) in jobs.items() if job_id not in leased]
+
+    def get_tasks(self):
+        """Return all the tasks of the job, loaded with a single query instead
+        of dereferencing them one by one.
+
+        :returns:  ``QuerySet`` of ``Task`` instances in creation order
+        """
+        return Task.objects(job_id=self.job_id).order_by('id')
+
+    def update_status(self, force=False):
+        """Work out the status of the job from the statuses of it's tasks,
+        counted with a single aggregation query. Unless ``force`` is set, the
+        job is marked erred or finished only after all of it's tasks have been
+        processed. Tasks waiting for a retry are already scheduled, so they
+        hold back the final status even if ``force`` is set.
+
+        :param force:  Set the final status even if some tasks are pending
+        :returns:      bool: whether the job reached it's final status
+        """
+        counts = Task.count_statuses(self.job_id)
+        is_pending = counts.get(Task.QUEUED) or counts.get(Task.PROCESSING)
+        if counts.get(Task.RETRYING) or (is_pending and not force):
+            return False
+
+        if counts.get(Task.FAILED):
+            self.mark_erred()
+        else:
+            self.mark_finished()
+
+        return True
+
+    def mark_queued(self, expected=None):
+        return self.transition(self.QUEUED, expected)
 
-    def mark_processing(self):
-        self.status = self.PROCESSING
-        self.save()
+    def mark_processing(self, expected=None):
+        return self.transition(self.PROCESSING, expected)
 
-    def mark_erred(self):
-        self.status = self.ERRED
-        self.save()
+    def mark_erred(self, expected=None):
+        return self.transition(self.ERRED, expected)
 
-    def mark_finished(self):
-        self.status = self.FINISHED
-        self.save()
+    def mark_finished(self, expected=None):
+        return self.transition(self.FINISHED, expected)
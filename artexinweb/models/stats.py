@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+import datetime
+
+import mongoengine
+
+from .jobs import Job, Task
+
+
+class Counter(mongoengine.Document):
+    """Named counters, used to collect statistics about the work done by the
+    background workers."""
+    name = mongoengine.StringField(required=True,
+                                   primary_key=True,
+                                   help_text="Name of the counter.")
+    value = mongoengine.IntField(default=0,
+                                 help_text="Current value of the counter.")
+
+    @classmethod
+    def increment(cls, name, amount=1):
+        """Atomically increment the counter of the passed in name, creating it
+        if it doesn't exist yet.
+
+        :param name:    Name of the counter
+        :param amount:  The amount by which the counter is incremented
+        """
+        cls.objects(name=name).update_one(inc__value=amount, upsert=True)
+
+    @classmethod
+    def get_value(cls, name):
+        """Return the current value of the counter of the passed in name.
+
+        :param name:  Name of the counter
+        :returns:     int
+        """
+        counter = cls.objects(name=name).first()
+        return counter.value if counter else 0
+
+
+def count_by_status(model):
+    """Count the documents of the passed in model per status. Each status is
+    counted with a separate query, which is answered from the indexes leading
+    with the status field, instead of scanning the whole collection.
+
+    :param model:  ``Job`` or ``Task``
+    :returns:      dict mapping statuses to counts
+    """
+    return dict((status, model.objects(status=status).count())
+                for (status, _) in model.STATUSES)
+
+
+def count_finished(**conditions):
+    """Count the tasks finished since each of the passed in times, with a
+    single aggregation query, which is restricted to the tasks finished since
+    the earliest of them by the index on status and update time.
+
+    :param conditions:  Name / datetime pairs
+    :returns:           dict mapping the names to counts
+    """
+    match = {'status': Task.FINISHED,
+             'updated': {'$gte': min(conditions.values())}}
+    group = {'_id': None}
+    for (name, since) in conditions.items():
+        is_recent = {'$gte': ['$updated', since]}
+        group[name] = {'$sum': {'$cond': [is_recent, 1, 0]}}
+
+    pipeline = [{'$match': match}, {'$group': group}]
+    results = list(Task._get_collection().aggregate(pipeline))
+    counts = results[0] if results else {}
+    return dict((name, counts.get(name, 0)) for name in conditions)
+
+
+def collect_stats():
+    """Collect the number of jobs and tasks per status, and the number of tasks
+    finished in the last hour and day.
+
+    :returns:  dict
+    """
+    now = datetime.datetime.utcnow()
+    finished = count_finished(last_hour=now - datetime.timedelta(hours=1),
+                              last_day=now - datetime.timedelta(days=1))
+    return {
+        'jobs': count_by_status(Job),
+        'tasks': count_by_status(Task),
+        'finished_last_hour': finished['last_hour'],
+        'finished_last_day': finished['last_day'],
+    }
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""Reclaiming of the tasks of dead workers.
+
+Workers hold a lease on each task they process, which they keep renewing for
+as long as they are alive, see ``BaseJobHandler.hold_lease``. If a worker is
+killed, the leases of it's tasks expire, and the tasks are sent to the workers
+again, until they reach the number of attempts set by the
+``artexin.max_attempts`` option, after which they are marked failed.
+
+Tasks waiting for a retry whose delayed messages were lost, and jobs whose
+worker died before taking any of their tasks, are sent to the workers again
+as well.
+"""
+import logging
+
+from artexinweb.models import Job, Task
+
+
+logger = logging.getLogger(__name__)
+
+
+def reclaim(now=None):
+    """Requeue the tasks whose leases expired, or mark them failed if they ran
+    out of attempts, and requeue the tasks whose retries were lost. In job
+    dispatch mode, the tasks of the affected jobs which were never started are
+    sent to the workers too, as they were left behind by the dead worker as
+    well, and so are the tasks of the stalled jobs. In task dispatch mode they
+    still have their own messages pending, so only the requeued tasks are
+    sent.
+
+    :param now:  Point in time the leases are compared to, defaults to now
+    :returns:    tuple of the number of requeued and failed tasks
+    """
+    max_attempts = Task.get_max_attempts()
+    (requeued, failed) = (0, 0)
+    # maps the IDs of the affected jobs to the IDs of their requeued tasks
+    affected_jobs = dict()
+    for task in Task.get_expired(now):
+        # the transitions fail if the task got finished in the meantime
+        if task.attempts >= max_attempts:
+            reason = "Lease expired after {0} attempts.".format(task.attempts)
+            if not task.mark_failed(reason, expected=[Task.PROCESSING]):
+                continue
+            failed += 1
+            affected_jobs.setdefault(task.job_id, [])
+        elif task.mark_queued(expected=[Task.PROCESSING]):
+            requeued += 1
+            affected_jobs.setdefault(task.job_id, []).append(task.id)
+        else:
+            continue
+
+        msg = "Reclaimed task {0} after {1} attempt(s), status: {2}."
+        logger.warning(msg.format(task.target, task.attempts, task.status))
+
+    for task in Task.get_lost_retries(now):
+        # the transition fails if the retry started in the meantime
+        if task.mark_queued(expected=[Task.RETRYING]):
+            requeued += 1
+            affected_jobs.setdefault(task.job_id, []).append(task.id)
+            msg = "Requeued task {0} after it's retry was lost."
+            logger.warning(msg.format(task.target))
+
+    is_job_dispatch = Job.get_dispatch_mode() == Job.DISPATCH_JOB
+    jobs = Job.objects(job_id__in=list(affected_jobs)).exclude('tasks')
+    for job in jobs:
+        if is_job_dispatch:
+            job.schedule_tasks(job.get_tasks().filter(status=Task.QUEUED))
+        else:
+            job.schedule_tasks(Task.objects(id__in=affected_jobs[job.job_id]))
+        job.update_status()
+
+    if is_job_dispatch:
+        for job in Job.get_stalled(now):
+            if job.job_id in affected_jobs:
+                continue
+            # queued again, so it's not reclaimed while waiting in the queue
+            if not job.mark_queued(expected=[Job.PROCESSING]):
+                continue
+            job.schedule_tasks(job.get_tasks().filter(status=Task.QUEUED))
+            job.update_status()
+            msg = "Reclaimed stalled {0} job: {1}."
+            logger.warning(msg.format(job.job_type, job.job_id))
+
+    return (requeued, failed)
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""Priority ordering of the messages sent to the workers.
+
+Messages are held in a redis sorted set per queue, and the huey queue only
+carries a token for each of them. Whenever a worker takes a token, it runs the
+message which is due first, so the order of processing is decided by the
+priorities of the messages, and not by the order they were sent in.
+"""
+import json
+import time
+
+from artexinweb import cache, settings
+
+
+KEY_PREFIX = 'artexinweb:pending:'
+
+# atomically remove and return the member with the lowest score
+POP_SCRIPT = """
+local members = redis.call('ZRANGE', KEYS[1], 0, 0)
+if #members == 0 then
+    return false
+end
+redis.call('ZREM', KEYS[1], members[1])
+return members[1]
+"""
+
+
+def get_aging():
+    """Return the number of seconds of waiting which are worth one level of
+    priority, as set by the ``artexin.priority_aging`` option."""
+    return float(settings.BOTTLE_CONFIG.get('artexin.priority_aging', 600))
+
+
+def get_score(priority, timestamp=None):
+    """Return the score of a message, by which messages are served in
+    ascending order. A message is treated as if it was sent ``priority *
+    aging`` seconds earlier than it actually was, so it overtakes messages of
+    lower priorities which are not waiting for too long already, and none of
+    the messages can be held back forever.
+
+    :param priority:   int: priority of the message
+    :param timestamp:  Time the message was sent at, defaults to now
+    :returns:          float
+    """
+    timestamp = time.time() if timestamp is None else timestamp
+    return timestamp - priority * get_aging()
+
+
+def push(queue_name, message, priority, pipeline=None):
+    """Add the passed in message to the pending messages of a queue. Sending
+    the same message again while it's still pending only updates it's score.
+
+    :param queue_name:  Name of one of the queues in ``settings.QUEUES``
+    :param message:     JSON serializable dict
+    :param priority:    int: priority of the message
+    :param pipeline:    Optional redis pipeline to add the command to
+    """
+    member = json.dumps(message, sort_keys=True)
+    connection = pipeline or cache.get_connection()
+    connection.execute_command('ZADD',
+                               KEY_PREFIX + queue_name,
+                               get_score(priority),
+                               member)
+
+
+def pop(queue_name):
+    """Remove and return the pending message of a queue which is due first.
+
+    :param queue_name:  Name of one of the queues in ``settings.QUEUES``
+    :returns:           dict: message, or ``None`` if there are none pending
+    """
+    connection = cache.get_connection()
+    script = connection.register_script(POP_SCRIPT)
+    member = script(keys=[KEY_PREFIX + queue_name])
+    if member is None:
+        return None
+
+    return json.loads(member.decode('utf-8'))
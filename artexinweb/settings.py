@@ -18,6 +18,7 @@ is_test_mode = lambda: ('py.test' in sys.argv or
 WEBAPP_ROOT = dirname(__file__)
 VIEW_ROOT = join(WEBAPP_ROOT, 'views')
 DEV_STATIC_ROOT = join(WEBAPP_ROOT, 'static')
+LOCALES_PATH = join(WEBAPP_ROOT, 'locales.json')
 
 DEFAULT_CONFIG_PATH = join(WEBAPP_ROOT, 'confs', 'dev.ini')
 CONFIG_PATH = environ.get('CONFIG_PATH', DEFAULT_CONFIG_PATH)
@@ -53,7 +54,18 @@ LOGGING = {
     }
 }
 
-huey = RedisHuey('job_queue',
-                 host=BOTTLE_CONFIG.get('redis.host', '127.0.0.1'),
-                 port=BOTTLE_CONFIG.get('redis.port', 6379),
-                 password=BOTTLE_CONFIG.get('redis.password', ''))
+REDIS_CONFIG = {
+    'host': BOTTLE_CONFIG.get('redis.host', '127.0.0.1'),
+    'port': int(BOTTLE_CONFIG.get('redis.port', 6379)),
+    'password': BOTTLE_CONFIG.get('redis.password', '') or None,
+}
+
+# names of the job queues, each of them consumed by it's own pool of workers
+QUEUE_FETCHABLE_JS = 'fetchable_js'
+QUEUE_FETCHABLE_STATIC = 'fetchable_static'
+QUEUE_STANDALONE = 'standalone'
+
+QUEUES = dict((name, RedisHuey(name, **REDIS_CONFIG))
+              for name in (QUEUE_FETCHABLE_JS,
+                           QUEUE_FETCHABLE_STATIC,
+                           QUEUE_STANDALONE))
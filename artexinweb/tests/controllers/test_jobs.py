@@ -1,13 +1,13 @@
 # -*- coding: utf-8 -*-
 import copy
-import io
-import json
 import os
 
 from unittest import mock
 
-from artexinweb import settings
-from artexinweb.models import Job
+import pytest
+
+from artexinweb import exceptions, settings
+from artexinweb.models import Job, Task, collect_stats
 
 
 def pass_through(template_name):
@@ -21,54 +21,66 @@ def pass_through(template_name):
 class TestJobControllers(object):
 
     @mock.patch('bottle.jinja2_view')
-    @mock.patch('artexinweb.models.jobs.Job.objects')
-    def test_job_dashboard(self, job_objects, jinja2_view):
+    @mock.patch('artexinweb.cache.get_or_set')
+    def test_job_dashboard(self, get_or_set, jinja2_view):
         jinja2_view.side_effect = pass_through
-        expected_count = 3
-
-        mocked_queryset = mock.Mock()
-        mocked_queryset.count.return_value = expected_count
-        job_objects.filter.return_value = mocked_queryset
+        stats = {'jobs': {Job.ERRED: 3},
+                 'tasks': {},
+                 'finished_last_hour': 1,
+                 'finished_last_day': 2}
+        get_or_set.return_value = stats
 
         from artexinweb.controllers.jobs import job_dashboard
         result = job_dashboard()
 
         assert result == {'erred_status': Job.ERRED,
-                          'erred_job_count': expected_count}
+                          'erred_job_count': 3,
+                          'stats': stats,
+                          'job_statuses': Job.STATUSES,
+                          'task_statuses': Task.STATUSES}
 
-        job_objects.filter.assert_called_once_with(status=Job.ERRED)
-        mocked_queryset.count.assert_called_once_with()
+        get_or_set.assert_called_once_with('dashboard', 10, collect_stats)
 
     @mock.patch('bottle.jinja2_view')
     @mock.patch('bottle.request')
-    @mock.patch('artexinweb.models.jobs.Job.objects')
-    def test_jobs_list(self, job_objects, bottle_request, jinja2_view):
+    @mock.patch('artexinweb.models.jobs.Job.get_page')
+    def test_jobs_list(self, get_page, bottle_request, jinja2_view):
         jinja2_view.side_effect = pass_through
         from artexinweb.controllers.jobs import jobs_list
         chosen_status = 'some_status'
+        query = {'status': chosen_status, 'cursor': 'cursor'}
 
-        bottle_request.query.get.return_value = chosen_status
-        job_objects.filter.return_value = [1]
+        bottle_request.query.get.side_effect = query.get
+        get_page.return_value = ([1], 'next')
 
         result = jobs_list()
         assert result == {'job_list': [1],
+                          'cursor': 'cursor',
+                          'next_cursor': 'next',
                           'current_status': chosen_status,
                           'statuses': Job.STATUSES}
 
-        job_objects.filter.assert_called_once_with(status=chosen_status)
+        get_page.assert_called_once_with(status=chosen_status,
+                                         cursor='cursor',
+                                         page_size=50)
 
-        bottle_request.query.get.return_value = None
-        job_objects.all.return_value = [2]
+    @mock.patch('bottle.abort')
+    @mock.patch('bottle.jinja2_view')
+    @mock.patch('bottle.request')
+    @mock.patch('artexinweb.models.jobs.Job.get_page')
+    def test_jobs_list_invalid_cursor(self, get_page, bottle_request,
+                                      jinja2_view, bottle_abort):
+        jinja2_view.side_effect = pass_through
+        from artexinweb.controllers.jobs import jobs_list
 
-        result = jobs_list()
-        assert result == {'job_list': [2],
-                          'current_status': None,
-                          'statuses': Job.STATUSES}
+        bottle_request.query.get.return_value = 'invalid'
+        get_page.side_effect = ValueError()
+        bottle_abort.side_effect = Exception()
 
-        job_objects.all.assert_called_once_with()
+        with pytest.raises(Exception):
+            jobs_list()
 
-        calls = [mock.call('status'), mock.call('status')]
-        bottle_request.query.get.assert_has_calls(calls)
+        bottle_abort.assert_called_once_with(400, "Invalid cursor.")
 
     @mock.patch('bottle.redirect')
     @mock.patch('artexinweb.models.jobs.Job.create')
@@ -82,38 +94,83 @@ class TestJobControllers(object):
 
         form.get_meta.assert_called_once_with()
 
-        assert job_create.call_count == 1
+        job_create.assert_called_once_with(job_type=Job.FETCHABLE,
+                                           targets=form.urls.data,
+                                           priority=form.priority.data,
+                                           extract=form.extract.data,
+                                           javascript=form.javascript.data,
+                                           meta=form.get_meta.return_value)
         assert result == 'redir'
 
     @mock.patch('uuid.uuid4')
     @mock.patch('os.makedirs')
-    @mock.patch('bottle.request')
+    @mock.patch('artexinweb.utils.save_upload')
     @mock.patch('bottle.redirect')
     @mock.patch('artexinweb.models.jobs.Job.create')
     def test_create_standalone_job(self, job_create, bottle_redirect,
-                                   bottle_request, os_makedirs, uuid_uuid4):
+                                   save_upload, os_makedirs, uuid_uuid4):
         from artexinweb.controllers.jobs import CreateJobController
 
         uuid_uuid4.return_value = 'test'
         bottle_redirect.return_value = 'redir'
+        save_upload.side_effect = ['a' * 32, 'b' * 32]
         file1 = mock.Mock(filename='file1.zip')
         file2 = mock.Mock(filename='file2.zip')
-        bottle_request.files.getlist.return_value = [file1, file2]
         form = mock.Mock()
+        form.files.data = [file1, file2]
 
-        result = CreateJobController.standalone(Job.STANDALONE, form)
+        config = {'web.max_upload_size': '1024'}
+        with mock.patch.dict('artexinweb.settings.BOTTLE_CONFIG', config):
+            result = CreateJobController.standalone(Job.STANDALONE, form)
         assert result == 'redir'
-        assert job_create.call_count == 1
 
         media_root = settings.BOTTLE_CONFIG.get('web.media_root', '')
         upload_dir = os.path.join(media_root, 'test')
         file1_path = os.path.join(upload_dir, file1.filename)
         file2_path = os.path.join(upload_dir, file2.filename)
 
-        file1.save.assert_called_once_with(file1_path)
-        file2.save.assert_called_once_with(file2_path)
+        save_upload.assert_has_calls([
+            mock.call(file1.file, file1_path, 1024),
+            mock.call(file2.file, file2_path, 1024),
+        ])
         os_makedirs.assert_called_once_with(upload_dir)
 
+        task_fields = {file1_path: {'source_md5': 'a' * 32, 'verified': True},
+                       file2_path: {'source_md5': 'b' * 32, 'verified': True}}
+        job_create.assert_called_once_with(job_type=Job.STANDALONE,
+                                           targets=[file1_path, file2_path],
+                                           task_fields=task_fields,
+                                           priority=form.priority.data,
+                                           origin=form.origin.data,
+                                           meta=form.get_meta.return_value)
+
+    @mock.patch('uuid.uuid4')
+    @mock.patch('os.makedirs')
+    @mock.patch('shutil.rmtree')
+    @mock.patch('artexinweb.utils.save_upload')
+    @mock.patch('bottle.jinja2_template')
+    @mock.patch('artexinweb.models.jobs.Job.create')
+    def test_create_standalone_job_too_large(self, job_create,
+                                             jinja2_template, save_upload,
+                                             rmtree, os_makedirs, uuid_uuid4):
+        from artexinweb.controllers.jobs import CreateJobController
+
+        uuid_uuid4.return_value = 'test'
+        save_upload.side_effect = exceptions.UploadTooLarge('too large')
+        form = mock.Mock()
+        form.files.data = [mock.Mock(filename='file1.zip')]
+        form.files.errors = []
+
+        CreateJobController.standalone(Job.STANDALONE, form)
+
+        assert not job_create.called
+        assert form.files.errors == ['too large']
+        media_root = settings.BOTTLE_CONFIG.get('web.media_root', '')
+        rmtree.assert_called_once_with(os.path.join(media_root, 'test'))
+        jinja2_template.assert_called_once_with('job_standalone.html',
+                                                form=form,
+                                                job_type=Job.STANDALONE)
+
     @mock.patch('bottle.request')
     @mock.patch.object(Job, 'is_valid_type')
     @mock.patch('artexinweb.controllers.jobs.CreateJobController')
@@ -174,6 +231,23 @@ class TestJobControllers(object):
         mocked_handler.assert_called_once_with(Job.FETCHABLE, form)
         is_valid_type.assert_called_once_with(Job.FETCHABLE)
 
+    @mock.patch('bottle.abort')
+    @mock.patch('bottle.request')
+    def test_jobs_create_too_large(self, bottle_request, bottle_abort):
+        from artexinweb.controllers.jobs import jobs_create
+
+        bottle_request.content_length = 1025
+        bottle_abort.side_effect = Exception()
+
+        config = {'web.max_upload_size': '1024'}
+        with mock.patch.dict('artexinweb.settings.BOTTLE_CONFIG', config):
+            with pytest.raises(Exception):
+                jobs_create()
+
+        bottle_abort.assert_called_once_with(413, mock.ANY)
+        assert not bottle_request.forms.get.called
+        assert not bottle_request.files.allitems.called
+
     @mock.patch('bottle.request')
     @mock.patch.object(Job, 'is_valid_type')
     @mock.patch('bottle.jinja2_template')
@@ -249,27 +323,28 @@ class TestJobControllers(object):
         job_id = 'job_id'
 
         job = mock.Mock(is_finished=False)
-        job_objects.get.return_value = job
+        job_objects.exclude.return_value.get.return_value = job
 
         result = jobs_retry(job_id)
 
         assert result == 'redir'
         job.retry.assert_called_once_with()
-        job_objects.get.assert_called_once_with(job_id=job_id)
+        job_objects.exclude.assert_called_once_with('tasks')
+        job_objects.exclude.return_value.get.assert_called_once_with(
+            job_id=job_id)
 
     @mock.patch('bottle.jinja2_view')
-    @mock.patch('artexinweb.models.jobs.Job.objects')
-    def test_task_list(self, job_objects, jinja2_view):
+    @mock.patch('artexinweb.models.jobs.Task.objects')
+    def test_task_list(self, task_objects, jinja2_view):
         jinja2_view.side_effect = pass_through
 
-        mocked_job = mock.Mock()
-        mocked_job.tasks = []
-        job_objects.get.return_value = mocked_job
+        tasks = task_objects.return_value.order_by.return_value
 
         from artexinweb.controllers.jobs import task_list
         result = task_list('job_id')
 
-        assert result == {'task_list': [], 'job_id': 'job_id'}
+        assert result == {'task_list': tasks, 'job_id': 'job_id'}
+        task_objects.assert_called_once_with(job_id='job_id')
 
     @mock.patch('bottle.jinja2_view')
     @mock.patch('artexinweb.models.jobs.Job.objects')
@@ -277,42 +352,37 @@ class TestJobControllers(object):
         jinja2_view.side_effect = pass_through
 
         mocked_job = mock.Mock()
-        mocked_job.tasks = []
-        job_objects.get.return_value = mocked_job
+        job_objects.exclude.return_value.get.return_value = mocked_job
 
         from artexinweb.controllers.jobs import jobs_details
         result = jobs_details('job_id')
 
         assert result == {'job': mocked_job}
+        job_objects.exclude.assert_called_once_with('tasks')
 
     @mock.patch('bottle.jinja2_template')
     @mock.patch('bottle.request')
-    @mock.patch('artexinweb.utils.read_from_zip')
     @mock.patch('artexinweb.controllers.jobs.MetaForm')
     @mock.patch('artexinweb.models.jobs.Task.objects')
-    def test_task_meta_edit_read(self, task_objects, meta_form, read_from_zip,
+    def test_task_meta_edit_read(self, task_objects, meta_form,
                                  bottle_request, jinja2_template):
         from artexinweb.controllers.jobs import task_meta_edit
         bottle_request.method = 'GET'
-        zipball_path = '/srv/zipballs/some_id.zip'
 
         form = mock.Mock()
         meta_form.return_value = form
 
-        task_id = 'task_id'
         meta = {'language': 'en',
                 'license': 'GFDL'}
-        meta_filename = '{0}/info.json'.format(task_id)
 
-        task = mock.Mock(zipball_path=zipball_path)
+        task = mock.Mock()
+        task.get_info.return_value = meta
         task_objects.get.return_value = task
 
-        meta_bytes = json.dumps(meta).encode('utf-8')
-        read_from_zip.return_value = io.BytesIO(meta_bytes)
-
-        task_meta_edit('job_id', task_id)
+        task_meta_edit('job_id', 'task_id')
 
-        read_from_zip.assert_called_once_with(zipball_path, meta_filename)
+        task.get_info.assert_called_once_with()
+        meta_form.assert_called_once_with(**meta)
         jinja2_template.assert_called_once_with('task_meta.html',
                                                 form=form,
                                                 meta=meta,
@@ -320,77 +390,58 @@ class TestJobControllers(object):
 
     @mock.patch('bottle.redirect')
     @mock.patch('bottle.request')
-    @mock.patch('artexinweb.utils.replace_in_zip')
-    @mock.patch('artexinweb.utils.read_from_zip')
     @mock.patch('artexinweb.controllers.jobs.MetaForm')
     @mock.patch('artexinweb.models.jobs.Task.objects')
     def test_task_meta_edit_form_valid(self, task_objects, meta_form,
-                                       read_from_zip, replace_in_zip,
                                        bottle_request, bottle_redirect):
         from artexinweb.controllers.jobs import task_meta_edit
         bottle_request.method = 'POST'
-        zipball_path = '/srv/zipballs/some_id.zip'
 
         form_data = {'language': 'de'}
         form = mock.Mock(data=form_data)
         form.validate.return_value = True
         meta_form.return_value = form
 
-        task_id = 'task_id'
         job_id = 'job_id'
         meta = {'language': 'en',
                 'license': 'GFDL'}
-        meta_filename = '{0}/info.json'.format(task_id)
 
-        task = mock.Mock(zipball_path=zipball_path)
+        task = mock.Mock()
+        task.get_info.return_value = meta
         task_objects.get.return_value = task
 
-        meta_bytes = json.dumps(meta).encode('utf-8')
-        read_from_zip.return_value = io.BytesIO(meta_bytes)
-
-        task_meta_edit(job_id, task_id)
-
-        read_from_zip.assert_called_once_with(zipball_path, meta_filename)
+        task_meta_edit(job_id, 'task_id')
 
         merged_meta = copy.copy(meta)
         merged_meta.update(form_data)
-        replacements = {meta_filename: json.dumps(merged_meta)}
-        replace_in_zip.assert_called_once_with(zipball_path, **replacements)
+        task.update_info.assert_called_once_with(merged_meta)
 
         task_list_url = '/jobs/{0}/tasks/'.format(job_id)
         bottle_redirect.assert_called_once_with(task_list_url)
 
     @mock.patch('bottle.jinja2_template')
     @mock.patch('bottle.request')
-    @mock.patch('artexinweb.utils.read_from_zip')
     @mock.patch('artexinweb.controllers.jobs.MetaForm')
     @mock.patch('artexinweb.models.jobs.Task.objects')
     def test_task_meta_edit_form_not_valid(self, task_objects, meta_form,
-                                           read_from_zip, bottle_request,
-                                           jinja2_template):
+                                           bottle_request, jinja2_template):
         from artexinweb.controllers.jobs import task_meta_edit
         bottle_request.method = 'POST'
-        zipball_path = '/srv/zipballs/some_id.zip'
 
         form = mock.Mock()
         form.validate.return_value = False
         meta_form.return_value = form
 
-        task_id = 'task_id'
-        job_id = 'job_id'
         meta = {'language': 'en',
                 'license': 'GFDL'}
-        meta_filename = '{0}/info.json'.format(task_id)
 
-        task = mock.Mock(zipball_path=zipball_path)
+        task = mock.Mock()
+        task.get_info.return_value = meta
         task_objects.get.return_value = task
 
-        meta_bytes = json.dumps(meta).encode('utf-8')
-        read_from_zip.return_value = io.BytesIO(meta_bytes)
-
-        task_meta_edit(job_id, task_id)
+        task_meta_edit('job_id', 'task_id')
 
-        read_from_zip.assert_called_once_with(zipball_path, meta_filename)
+        assert not task.update_info.called
         jinja2_template.assert_called_once_with('task_meta.html',
                                                 form=form,
                                                 meta=meta,
@@ -1,6 +1,9 @@
 # -*- coding: utf-8 -*-
+import threading
+
 from unittest import mock
 
+from artexinweb import exceptions
 from artexinweb.handlers.base import BaseJobHandler
 from artexinweb.models import Job, Task
 from artexinweb.tests.base import BaseMongoTestCase
@@ -81,6 +84,91 @@ class TestBaseJobHandler(BaseMongoTestCase):
         calls = [mock.call(task, job.options) for task in job.tasks]
         process_task.assert_has_calls(calls)
 
+    def test_get_concurrency(self):
+        handler = BaseJobHandler()
+        with mock.patch.dict('artexinweb.settings.BOTTLE_CONFIG',
+                             {'artexin.concurrency': '4'}):
+            assert handler.get_concurrency() == 4
+
+        with mock.patch.dict('artexinweb.settings.BOTTLE_CONFIG',
+                             {'artexin.concurrency': '0'}):
+            assert handler.get_concurrency() == 1
+
+    @mock.patch('artexinweb.worker.dispatch')
+    @mock.patch('artexinweb.handlers.base.BaseJobHandler.get_concurrency')
+    @mock.patch('artexinweb.models.Job.mark_finished')
+    @mock.patch('artexinweb.models.Job.mark_erred')
+    @mock.patch('artexinweb.models.Job.mark_processing')
+    def test_run_concurrent(self, mark_processing, mark_erred, mark_finished,
+                            get_concurrency, *args):
+        get_concurrency.return_value = 2
+        job = Job.create(targets=self.targets,
+                         job_type=Job.FETCHABLE,
+                         extract=True,
+                         javascript=True)
+
+        def process_task(task, options):
+            if task.target == self.targets[1]:
+                task.mark_failed("failed")
+            else:
+                task.mark_finished()
+
+        handler = BaseJobHandler()
+        with mock.patch.object(handler,
+                               'process_task',
+                               side_effect=process_task) as mocked:
+            handler.run({'type': job.job_type, 'id': job.job_id})
+
+            assert mocked.call_count == len(self.targets)
+
+        mark_processing.assert_called_once_with()
+        mark_erred.assert_called_once_with()
+        assert not mark_finished.called
+
+    @mock.patch('artexinweb.worker.dispatch')
+    @mock.patch('artexinweb.handlers.base.BaseJobHandler.process_task')
+    @mock.patch('artexinweb.models.Job.mark_finished')
+    @mock.patch('artexinweb.models.Job.mark_erred')
+    @mock.patch('artexinweb.models.Job.mark_processing')
+    def test_run_process_task_crash(self, mark_processing, mark_erred,
+                                    mark_finished, process_task, *args):
+        job = Job.create(targets=self.targets,
+                         job_type=Job.FETCHABLE,
+                         extract=True,
+                         javascript=True)
+        process_task.side_effect = Exception()
+
+        handler = BaseJobHandler()
+        handler.run({'type': job.job_type, 'id': job.job_id})
+
+        mark_erred.assert_called_once_with()
+        assert not mark_finished.called
+
+    @mock.patch('artexinweb.worker.dispatch')
+    @mock.patch('artexinweb.handlers.base.BaseJobHandler.process_task')
+    def test_run_task(self, process_task, *args):
+        job = Job.create(targets=self.targets,
+                         job_type=Job.FETCHABLE,
+                         extract=True,
+                         javascript=True)
+        process_task.side_effect = lambda task, *args: task.mark_finished()
+        handler = BaseJobHandler()
+
+        handler.run({'id': job.job_id, 'task': str(job.tasks[0].id)})
+        job.reload()
+        assert job.is_processing is True
+
+        handler.run({'id': job.job_id,
+                     'task': str(job.tasks[1].id),
+                     'status': Task.RETRYING})
+        job.reload()
+        assert job.is_finished is True
+
+        process_task.assert_has_calls([mock.call(mock.ANY, job.options, None),
+                                       mock.call(mock.ANY,
+                                                 job.options,
+                                                 Task.RETRYING)])
+
     @mock.patch('artexinweb.handlers.base.BaseJobHandler.handle_task')
     @mock.patch('artexinweb.models.Task.mark_failed')
     def test_process_task_invalid_target(self, mark_failed, handle_task):
@@ -93,6 +181,20 @@ class TestBaseJobHandler(BaseMongoTestCase):
             assert mark_failed.call_count == 1
             assert not handle_task.called
 
+    @mock.patch('artexinweb.handlers.base.BaseJobHandler.handle_task_result')
+    @mock.patch('artexinweb.handlers.base.BaseJobHandler.handle_task')
+    def test_process_task_verified_target(self, handle_task,
+                                          handle_task_result):
+        task = Task.create(self.job_id, self.targets[0])
+        task.verified = True
+
+        handler = BaseJobHandler()
+        with mock.patch.object(handler, 'is_valid_target') as is_valid_target:
+            handler.process_task(task, {})
+
+            assert not is_valid_target.called
+            handle_task.assert_called_once_with(task, {})
+
     @mock.patch('artexinweb.handlers.base.BaseJobHandler.handle_task_result')
     @mock.patch('artexinweb.handlers.base.BaseJobHandler.handle_task')
     @mock.patch('artexinweb.models.Task.mark_failed')
@@ -155,3 +257,114 @@ class TestBaseJobHandler(BaseMongoTestCase):
                                                        task_result,
                                                        options)
             assert mark_failed.call_count == 1
+
+    @mock.patch('artexinweb.handlers.base.BaseJobHandler.handle_task')
+    def test_process_task_already_processing(self, handle_task):
+        task = Task.create(self.job_id, self.targets[0])
+        # another worker took the task since it was loaded
+        Task.objects(id=task.id).update_one(set__status=Task.PROCESSING,
+                                            set__attempts=1)
+
+        handler = BaseJobHandler()
+        handler.process_task(task, {})
+
+        assert not handle_task.called
+        assert Task.objects.get(id=task.id).attempts == 1
+
+    @mock.patch('artexinweb.handlers.base.BaseJobHandler.handle_task')
+    def test_process_task_retrying(self, handle_task):
+        task = Task.create(self.job_id, self.targets[0])
+        task.mark_retrying("timeout")
+
+        handler = BaseJobHandler()
+        with mock.patch.object(handler, 'is_valid_target', return_value=True):
+            # only the delayed message of the retry may take the task
+            handler.process_task(task, {})
+            assert not handle_task.called
+
+            handler.process_task(task, {}, Task.RETRYING)
+            assert handle_task.call_count == 1
+
+    def test_hold_lease(self):
+        task = Task.create(self.job_id, self.targets[0])
+        task.mark_processing()
+        renewed = threading.Event()
+
+        handler = BaseJobHandler()
+        config = {'artexin.lease_duration': '0'}
+        with mock.patch.dict('artexinweb.settings.BOTTLE_CONFIG', config):
+            with mock.patch.object(task, 'renew_lease',
+                                   side_effect=renewed.set):
+                with handler.hold_lease(task):
+                    assert renewed.wait(5) is True
+
+    def test_get_retry_delay(self):
+        handler = BaseJobHandler()
+        config = {'artexin.retry_delay': '10',
+                  'artexin.max_retry_delay': '25'}
+        with mock.patch.dict('artexinweb.settings.BOTTLE_CONFIG', config):
+            assert 5 <= handler.get_retry_delay(1) <= 10
+            assert 10 <= handler.get_retry_delay(2) <= 20
+            assert 12.5 <= handler.get_retry_delay(5) <= 25
+
+    @mock.patch('artexinweb.worker.dispatch')
+    def test_fail_task_transient(self, dispatch):
+        job = Job.create(targets=self.targets, job_type=Job.FETCHABLE)
+        task = job.tasks[0]
+        task.mark_processing()
+        dispatch.reset_mock()
+
+        handler = BaseJobHandler()
+        with mock.patch.object(handler, 'get_retry_delay', return_value=30):
+            handler.fail_task(task, "timeout", exceptions.TransientError())
+
+        assert Task.objects.get(id=task.id).is_retrying is True
+        dispatch.assert_called_once_with({'type': job.job_type,
+                                          'id': job.job_id,
+                                          'task': str(task.id),
+                                          'status': Task.RETRYING},
+                                         job.get_queue_name(),
+                                         job.priority,
+                                         delay=30)
+
+    @mock.patch('artexinweb.worker.dispatch')
+    def test_fail_task_permanent(self, dispatch):
+        job = Job.create(targets=self.targets, job_type=Job.FETCHABLE)
+        task = job.tasks[0]
+        task.mark_processing()
+        dispatch.reset_mock()
+
+        handler = BaseJobHandler()
+        handler.fail_task(task, "invalid", ValueError())
+
+        assert Task.objects.get(id=task.id).is_failed is True
+        assert not dispatch.called
+
+    @mock.patch('artexinweb.worker.dispatch')
+    def test_fail_task_out_of_attempts(self, dispatch):
+        job = Job.create(targets=self.targets, job_type=Job.FETCHABLE)
+        task = job.tasks[0]
+        for _ in range(3):
+            task.mark_processing()
+        dispatch.reset_mock()
+
+        handler = BaseJobHandler()
+        with mock.patch.dict('artexinweb.settings.BOTTLE_CONFIG',
+                             {'artexin.max_attempts': '3'}):
+            handler.fail_task(task, "timeout", exceptions.TransientError())
+
+        assert Task.objects.get(id=task.id).is_failed is True
+        assert not dispatch.called
+
+    @mock.patch('artexinweb.handlers.base.BaseJobHandler.fail_task')
+    @mock.patch('artexinweb.handlers.base.BaseJobHandler.handle_task')
+    def test_process_task_validation_error(self, handle_task, fail_task):
+        task = Task.create(self.job_id, self.targets[0])
+        error = exceptions.TransientError()
+
+        handler = BaseJobHandler()
+        with mock.patch.object(handler, 'is_valid_target', side_effect=error):
+            handler.process_task(task, {})
+
+        fail_task.assert_called_once_with(task, mock.ANY, error)
+        assert not handle_task.called
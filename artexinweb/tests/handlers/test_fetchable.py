@@ -1,10 +1,15 @@
 # -*- coding: utf-8 -*-
 import datetime
+import socket
+import urllib.error
 
 from unittest import mock
 
+import pytest
+
+from artexinweb import exceptions
 from artexinweb.handlers.fetchable import FetchableHandler
-from artexinweb.models import Task
+from artexinweb.models import Counter, Task
 from artexinweb.tests.base import BaseMongoTestCase
 from artexinweb.tests.mocks import mock_bottle_config
 
@@ -16,25 +21,148 @@ class TestFetchableHandler(BaseMongoTestCase):
         cls.job_id = 'a' * 32
         cls.target = 'http://en.wikipedia.org/wiki/Prime_factor'
 
-    @mock.patch('urllib.request.urlopen')
-    def test_is_valid_target_success(self, urlopen):
+    @mock.patch('artexinweb.hosts.HostPool.request')
+    def test_is_valid_target_success(self, request):
+        target = 'http://www.target.com'
+        request.return_value = (200, {})
+        handler = FetchableHandler()
+        result = handler.is_valid_target(target)
+
+        assert result is True
+        timeout = handler.get_validation_timeout()
+        request.assert_called_once_with('HEAD', target, {}, timeout)
+
+    @mock.patch('artexinweb.hosts.HostPool.request')
+    def test_is_valid_target_stores_validators(self, request):
+        target = 'http://www.target.com'
+        request.return_value = (200, {'ETag': '"abc"',
+                                      'Last-Modified': 'some date'})
+        handler = FetchableHandler()
+        handler.is_valid_target(target)
+
+        assert handler.validators[target] == ('"abc"', 'some date')
+
+    @mock.patch('artexinweb.hosts.HostPool.request')
+    def test_is_valid_target_head_rejected(self, request):
         target = 'http://www.target.com'
+        request.side_effect = [(405, {}), (206, {})]
+
         handler = FetchableHandler()
         result = handler.is_valid_target(target)
 
         assert result is True
-        urlopen.assert_called_once_with(target)
+        timeout = handler.get_validation_timeout()
+        request.assert_has_calls([
+            mock.call('HEAD', target, {}, timeout),
+            mock.call('GET', target, {'Range': 'bytes=0-0'}, timeout)
+        ])
 
-    @mock.patch('urllib.request.urlopen')
-    def test_is_valid_target_failure(self, urlopen):
+    @mock.patch('artexinweb.hosts.HostPool.request')
+    def test_is_valid_target_failure(self, request):
         target = 'http://www.target.com'
-        urlopen.side_effect = Exception()
+        request.side_effect = Exception()
 
         handler = FetchableHandler()
         result = handler.is_valid_target(target)
 
         assert result is False
-        urlopen.assert_called_once_with(target)
+        assert request.call_count == 1
+
+    @mock.patch('artexinweb.hosts.HostPool.request')
+    def test_is_valid_target_not_found(self, request):
+        target = 'http://www.target.com'
+        request.return_value = (404, {})
+
+        handler = FetchableHandler()
+        result = handler.is_valid_target(target)
+
+        assert result is False
+        assert request.call_count == 1
+
+    @mock.patch('artexinweb.hosts.HostPool.request')
+    def test_is_valid_target_server_error(self, request):
+        request.return_value = (503, {})
+
+        handler = FetchableHandler()
+        with pytest.raises(exceptions.TransientError):
+            handler.is_valid_target('http://www.target.com')
+
+    @mock.patch('artexinweb.hosts.HostPool.request')
+    def test_is_valid_target_timeout(self, request):
+        request.side_effect = socket.timeout()
+
+        handler = FetchableHandler()
+        with pytest.raises(socket.timeout):
+            handler.is_valid_target('http://www.target.com')
+
+    def test_is_transient_error(self):
+        handler = FetchableHandler()
+        url = 'http://www.target.com'
+
+        assert handler.is_transient_error(socket.timeout()) is True
+        assert handler.is_transient_error(ConnectionResetError()) is True
+        assert handler.is_transient_error(
+            urllib.error.HTTPError(url, 502, 'Bad Gateway', {}, None)
+        ) is True
+        assert handler.is_transient_error(
+            urllib.error.URLError(ConnectionRefusedError())
+        ) is True
+        assert handler.is_transient_error('Read timed out.') is True
+        assert handler.is_transient_error('503 Service Unavailable') is True
+
+        assert handler.is_transient_error(
+            urllib.error.HTTPError(url, 404, 'Not Found', {}, None)
+        ) is False
+        assert handler.is_transient_error(ValueError()) is False
+        assert handler.is_transient_error('404 Not Found') is False
+        assert handler.is_transient_error(None) is False
+
+    def test_is_transient_error_cause(self):
+        handler = FetchableHandler()
+        try:
+            try:
+                raise ConnectionResetError()
+            except ConnectionResetError as exc:
+                raise RuntimeError("fetch failed") from exc
+        except RuntimeError as exc:
+            assert handler.is_transient_error(exc) is True
+
+    def test_order_tasks(self):
+        tasks = [mock.Mock(target='http://a.com/1'),
+                 mock.Mock(target='http://a.com/2'),
+                 mock.Mock(target='http://a.com/3'),
+                 mock.Mock(target='http://b.com/1')]
+
+        handler = FetchableHandler()
+        ordered = handler.order_tasks(tasks)
+
+        assert ordered == [tasks[0], tasks[3], tasks[1], tasks[2]]
+
+    @mock.patch('artexin.pack.collect')
+    @mock.patch('artexin.preprocessor_mappings.get_preps')
+    def test_handle_task_takes_host_slot(self, get_preps, collect):
+        task = Task.create(self.job_id, self.target)
+        host = mock.MagicMock()
+        slot = host.slot.return_value
+
+        def assert_in_slot(*args, **kwargs):
+            assert slot.__enter__.called
+            assert not slot.__exit__.called
+            return {}
+
+        collect.side_effect = assert_in_slot
+
+        handler = FetchableHandler()
+        with mock_bottle_config('artexinweb.settings.BOTTLE_CONFIG',
+                                {'artexin.out_dir': '/test/out'}):
+            with mock.patch.object(handler.host_pool, 'get',
+                                   return_value=host):
+                handler.handle_task(task, {})
+
+                handler.host_pool.get.assert_called_once_with(task.target)
+
+        assert collect.called
+        assert slot.__exit__.called
 
     @mock.patch('artexinweb.models.Task.mark_finished')
     @mock.patch('artexinweb.models.Task.mark_failed')
@@ -49,10 +177,29 @@ class TestFetchableHandler(BaseMongoTestCase):
         assert not mark_finished.called
         assert mark_failed.call_count == 1
 
+    @mock.patch('artexinweb.handlers.base.BaseJobHandler.fail_task')
+    def test_handle_task_result_error(self, fail_task):
+        task = Task.create(self.job_id, self.target)
+        result = {'error': 'Connection reset by peer'}
+
+        handler = FetchableHandler()
+        handler.handle_task_result(task, result, {})
+
+        fail_task.assert_called_once_with(task,
+                                          mock.ANY,
+                                          'Connection reset by peer')
+
+    @mock.patch('artexinweb.models.Task.read_zipball_info')
     @mock.patch('artexinweb.models.Task.mark_finished')
     @mock.patch('artexinweb.models.Task.mark_failed')
-    def test_handle_task_result_success(self, mark_failed, mark_finished):
+    def test_handle_task_result_success(self, mark_failed, mark_finished,
+                                        read_zipball_info):
+        read_zipball_info.return_value = {'title': 'Target title'}
         task = Task.create(self.job_id, self.target)
+        # a previously finished task with the same zipball
+        sharing = Task.create(self.job_id, self.target)
+        Task.objects(id=sharing.id).update_one(set__md5=self.job_id,
+                                               set__info={'title': 'old'})
         result = {'size': 1024,
                   'hash': self.job_id,
                   'title': 'Target title',
@@ -70,7 +217,9 @@ class TestFetchableHandler(BaseMongoTestCase):
         assert task.md5 == result['hash']
         assert task.title == result['title']
         assert task.images == result['images']
+        assert task.info == {'title': 'Target title'}
         assert task.timestamp == result['timestamp']
+        assert Task.objects.get(id=sharing.id).info == task.info
 
     @mock.patch('artexin.pack.collect')
     @mock.patch('artexin.preprocessor_mappings.get_preps')
@@ -102,3 +251,134 @@ class TestFetchableHandler(BaseMongoTestCase):
                                         javascript=True,
                                         do_extract=True,
                                         meta={})
+
+    def _create_cached_task(self, handler, options, timestamp):
+        cached = Task.create(self.job_id, self.target)
+        cached.fingerprint = handler.get_fingerprint(self.target, options)
+        cached.size = 1024
+        cached.md5 = 'b' * 32
+        cached.title = 'Target title'
+        cached.images = 3
+        cached.timestamp = timestamp
+        cached.mark_finished()
+        return cached
+
+    def test_get_fingerprint(self):
+        handler = FetchableHandler()
+        options = {'javascript': True, 'meta': {'a': 1, 'b': 2}}
+
+        fingerprint = handler.get_fingerprint(self.target, options)
+        assert len(fingerprint) == 32
+
+        same_target = 'HTTP://EN.wikipedia.org/wiki/Prime_factor#History'
+        same_options = {'javascript': True, 'meta': {'b': 2, 'a': 1}}
+        assert handler.get_fingerprint(same_target,
+                                       same_options) == fingerprint
+
+        other_options = {'javascript': False, 'meta': {'a': 1, 'b': 2}}
+        assert handler.get_fingerprint(self.target,
+                                       other_options) != fingerprint
+
+    @mock.patch('os.path.isfile')
+    @mock.patch('artexin.pack.collect')
+    def test_handle_task_cache_hit(self, collect, isfile):
+        isfile.return_value = True
+        options = {'javascript': True, 'extract': True}
+        handler = FetchableHandler()
+        now = datetime.datetime.utcnow().replace(microsecond=0)
+        config = {'artexin.cache_freshness': '3600',
+                  'artexin.out_dir': '/test/out'}
+
+        with mock.patch.dict('artexinweb.settings.BOTTLE_CONFIG', config):
+            cached = self._create_cached_task(handler, options, now)
+            task = Task.create(self.job_id, self.target)
+            result = handler.handle_task(task, options)
+
+        assert not collect.called
+        assert task.fingerprint == cached.fingerprint
+        assert result == {'size': cached.size,
+                          'hash': cached.md5,
+                          'title': cached.title,
+                          'images': cached.images,
+                          'timestamp': cached.timestamp}
+        assert Counter.get_value(handler.CACHE_HITS) == 1
+
+    @mock.patch('os.path.isfile')
+    def test_find_cached_eviction(self, isfile):
+        options = {}
+        handler = FetchableHandler()
+        now = datetime.datetime.utcnow()
+        config = {'artexin.cache_freshness': '3600',
+                  'artexin.out_dir': '/test/out'}
+
+        with mock.patch.dict('artexinweb.settings.BOTTLE_CONFIG', config):
+            task = Task.create(self.job_id, self.target)
+            task.fingerprint = handler.get_fingerprint(self.target, options)
+            assert handler.find_cached(task) is None
+            assert Counter.get_value(handler.CACHE_MISSES) == 1
+
+            # stale entry
+            stale = now - datetime.timedelta(hours=2)
+            cached = self._create_cached_task(handler, options, stale)
+            isfile.return_value = True
+            assert handler.find_cached(task) is None
+
+            # fresh entry, but the zipball is gone
+            cached.timestamp = now
+            cached.save()
+            isfile.return_value = False
+            assert handler.find_cached(task) is None
+            assert Counter.get_value(handler.CACHE_EVICTIONS) == 2
+
+    @mock.patch('os.path.isfile')
+    @mock.patch('artexinweb.hosts.HostPool.request')
+    @mock.patch('artexin.pack.collect')
+    def test_handle_task_not_modified(self, collect, request, isfile):
+        isfile.return_value = True
+        request.return_value = (304, {})
+        options = {}
+        handler = FetchableHandler()
+        then = datetime.datetime(2015, 1, 1)
+        config = {'artexin.out_dir': '/test/out'}
+
+        with mock.patch.dict('artexinweb.settings.BOTTLE_CONFIG', config):
+            previous = self._create_cached_task(handler, options, then)
+            previous.etag = '"abc"'
+            previous.last_modified = 'Thu, 01 Jan 2015 00:00:00 GMT'
+            previous.save()
+
+            task = Task.create(self.job_id, self.target)
+            result = handler.handle_task(task, options)
+
+        assert not collect.called
+        assert result['hash'] == previous.md5
+        assert result['timestamp'] > then
+        assert task.etag == previous.etag
+        assert task.last_modified == previous.last_modified
+
+        (method, url, headers, timeout), _ = request.call_args
+        assert method == 'HEAD'
+        assert headers == {'If-None-Match': previous.etag,
+                           'If-Modified-Since': previous.last_modified}
+
+    @mock.patch('os.path.isfile')
+    @mock.patch('artexinweb.hosts.HostPool.request')
+    def test_find_unmodified_changed(self, request, isfile):
+        isfile.return_value = True
+        request.return_value = (200, {'ETag': '"new"'})
+        options = {}
+        handler = FetchableHandler()
+        config = {'artexin.out_dir': '/test/out'}
+
+        with mock.patch.dict('artexinweb.settings.BOTTLE_CONFIG', config):
+            previous = self._create_cached_task(handler, options,
+                                                datetime.datetime.utcnow())
+            previous.etag = '"old"'
+            previous.save()
+
+            task = Task.create(self.job_id, self.target)
+            task.fingerprint = previous.fingerprint
+            assert handler.find_unmodified(task) is None
+
+        assert task.etag == '"new"'
+        assert task.last_modified is None
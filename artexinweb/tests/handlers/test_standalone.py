@@ -1,12 +1,16 @@
 # -*- coding: utf-8 -*-
 import datetime
+import imghdr
 import os
 import urllib
+import zipfile
 
 from unittest import mock
 
 import pytest
 
+from lxml import etree
+
 from artexinweb import exceptions
 from artexinweb.handlers.standalone import StandaloneHandler
 from artexinweb.models import Task
@@ -74,10 +78,13 @@ class TestStandaloneHandler(BaseMongoTestCase):
             handler.get_extractor('test.rar')
 
     @mock.patch('tempfile.mkdtemp')
+    @mock.patch('artexinweb.handlers.standalone.StandaloneHandler.get_extraction_workers')  # NOQA
     @mock.patch('artexinweb.handlers.standalone.StandaloneHandler.get_extractor')  # NOQA
-    def test_extract_target(self, get_extractor, mkdtemp):
+    def test_extract_target(self, get_extractor, get_extraction_workers,
+                            mkdtemp):
         extractor = mock.Mock()
         get_extractor.return_value = extractor
+        get_extraction_workers.return_value = 4
 
         mkdtemp.return_value = '/tmp/some_folder'
 
@@ -86,27 +93,50 @@ class TestStandaloneHandler(BaseMongoTestCase):
 
         dest_dir = '/tmp/some_folder'
         get_extractor.assert_called_once_with(self.target)
-        extractor.assert_called_once_with(self.target, dest_dir)
+        extractor.assert_called_once_with(self.target, dest_dir, workers=4)
+
+    @mock.patch('os.path.getsize')
+    def test_get_extraction_workers(self, getsize):
+        config = {'artexin.parallel_extraction': '1000',
+                  'artexin.extraction_workers': '4'}
+        handler = StandaloneHandler()
+
+        with mock.patch.dict('artexinweb.settings.BOTTLE_CONFIG', config):
+            getsize.return_value = 999
+            assert handler.get_extraction_workers(self.target) == 1
+
+            getsize.return_value = 1000
+            assert handler.get_extraction_workers(self.target) == 4
+
+        getsize.assert_called_with(self.target)
 
-    @mock.patch('os.walk')
-    @mock.patch('imghdr.what')
-    def test_count_images(self, what, walk):
-        image_paths = [(None, None, ['test.gif']),
-                       (None, None, ['another.jpg']),
-                       (None, None, ['catch.jpg'])]
-        walk.return_value = image_paths
-        what.return_value = True
+    def test_count_images(self, tmpdir):
+        zip_path = str(tmpdir.join('bundle.zip'))
+        png_data = b'\x89PNG\r\n\x1a\n' + b'\x00' * 100
+        with zipfile.ZipFile(zip_path, 'w') as zf:
+            zf.writestr('index.html', b'<html></html>')
+            zf.writestr('images/', b'')
+            zf.writestr('images/test.gif', b'GIF89a' + b'\x00' * 10)
+            zf.writestr('images/another.JPG', b'\xff\xd8' + b'\x00' * 20)
+            zf.writestr('images/noextension', png_data)
+            zf.writestr('images/unknown.dat', b'not an image')
+            zf.writestr('style.css', b'body {}')
 
         handler = StandaloneHandler()
-        result = handler.count_images(self.temp_dir)
+        with mock.patch('imghdr.what', wraps=imghdr.what) as what:
+            result = handler.count_images(zip_path)
 
-        assert result == len(image_paths)
+        assert result == (3, 16 + 22 + len(png_data))
+        # only the files with unknown extensions were sniffed
+        assert what.call_count == 2
 
     @mock.patch('artexin.extract.get_title')
     @mock.patch('bs4.BeautifulSoup')
     @mock.patch('os.listdir')
-    def _read_title_test(self, file_list, expected_html_file, listdir,
-                         beautiful_soup, get_title, ):
+    @mock.patch('artexinweb.handlers.standalone.StandaloneHandler.find_title')
+    def _read_title_test(self, file_list, expected_html_file, find_title,
+                         listdir, beautiful_soup, get_title, ):
+        find_title.return_value = None
         listdir.return_value = file_list
         title = 'page title'
         get_title.return_value = title
@@ -137,6 +167,51 @@ class TestStandaloneHandler(BaseMongoTestCase):
         expected_html_file = 'index.html'
         self._read_title_test(file_list, expected_html_file)
 
+    @mock.patch('bs4.BeautifulSoup')
+    @mock.patch('os.listdir')
+    @mock.patch('artexinweb.handlers.standalone.StandaloneHandler.find_title')
+    def test_read_title_streamed(self, find_title, listdir, beautiful_soup):
+        find_title.return_value = 'page title'
+        listdir.return_value = ['index.html']
+
+        handler = StandaloneHandler()
+        result = handler.read_title(self.temp_dir)
+
+        assert result == 'page title'
+        html_path = os.path.join(self.temp_dir, 'index.html')
+        find_title.assert_called_once_with(html_path)
+        assert not beautiful_soup.called
+
+    def test_find_title(self, tmpdir):
+        html_path = tmpdir.join('index.html')
+        html_path.write_binary('<html><head><title> Prím tényező </title>'
+                               '</head><body>'.encode('utf-8') +
+                               b'<p>content</p>' * 10000 +
+                               b'</body></html>')
+
+        fed = []
+
+        class RecordingParser(etree.HTMLPullParser):
+            def feed(self, data):
+                fed.append(data)
+                return super(RecordingParser, self).feed(data)
+
+        handler = StandaloneHandler()
+        with mock.patch.object(etree, 'HTMLPullParser', RecordingParser):
+            result = handler.find_title(str(html_path))
+
+        assert result == 'Prím tényező'
+        # the body of the document was not read
+        assert len(fed) == 1
+
+    def test_find_title_not_in_head(self, tmpdir):
+        html_path = tmpdir.join('index.html')
+        html_path.write_binary(b'<html><head></head><body>'
+                               b'<title>late</title></body></html>')
+
+        handler = StandaloneHandler()
+        assert handler.find_title(str(html_path)) is None
+
     def test_read_title_fallback(self):
         file_list = ['test.jpg',
                      'onlythis.html',
@@ -159,12 +234,14 @@ class TestStandaloneHandler(BaseMongoTestCase):
 
         expected_meta = {'title': 'page title',
                          'images': 4,
+                         'image_size': 1024,
                          'url': self.origin,
                          'domain': urllib.parse.urlparse(self.origin).netloc}
 
         extract_target.return_value = self.temp_dir
         read_title.return_value = expected_meta['title']
-        count_images.return_value = expected_meta['images']
+        count_images.return_value = (expected_meta['images'],
+                                     expected_meta['image_size'])
 
         def mocked_create_zipball(*args, **kwargs):
             return kwargs['meta']
@@ -187,7 +264,7 @@ class TestStandaloneHandler(BaseMongoTestCase):
 
         extract_target.assert_called_once_with(task.target)
         read_title.assert_called_once_with(self.temp_dir)
-        count_images.assert_called_once_with(self.temp_dir)
+        count_images.assert_called_once_with(task.target)
         shutil_rmtree.assert_called_once_with(self.temp_dir)
 
         assert len(result) == len(expected_meta) + 1
@@ -213,12 +290,14 @@ class TestStandaloneHandler(BaseMongoTestCase):
 
         expected_meta = {'title': 'overridden',
                          'images': 4,
+                         'image_size': 1024,
                          'url': self.origin,
                          'domain': urllib.parse.urlparse(self.origin).netloc}
 
         extract_target.return_value = self.temp_dir
         read_title.return_value = 'title actually found'
-        count_images.return_value = expected_meta['images']
+        count_images.return_value = (expected_meta['images'],
+                                     expected_meta['image_size'])
 
         def mocked_create_zipball(*args, **kwargs):
             return kwargs['meta']
@@ -241,7 +320,7 @@ class TestStandaloneHandler(BaseMongoTestCase):
 
         extract_target.assert_called_once_with(task.target)
         assert read_title.called is False
-        count_images.assert_called_once_with(self.temp_dir)
+        count_images.assert_called_once_with(task.target)
         shutil_rmtree.assert_called_once_with(self.temp_dir)
 
         assert len(result) == len(expected_meta) + 1
@@ -251,14 +330,17 @@ class TestStandaloneHandler(BaseMongoTestCase):
 
         assert isinstance(result['timestamp'], datetime.datetime)
 
+    @mock.patch('artexinweb.models.Task.read_zipball_info')
     @mock.patch('artexinweb.models.Task.mark_finished')
-    def test_handle_task_result(self, mark_finished):
+    def test_handle_task_result(self, mark_finished, read_zipball_info):
+        read_zipball_info.return_value = {'title': 'page title'}
         task = Task.create(self.job_id, self.temp_dir)
 
         result = {'size': 1234,
                   'hash': 'a' * 32,
                   'title': 'page title',
                   'images': 12,
+                  'image_size': 4096,
                   'timestamp': datetime.datetime.utcnow()}
 
         handler = StandaloneHandler()
@@ -270,4 +352,6 @@ class TestStandaloneHandler(BaseMongoTestCase):
         assert task.md5 == result['hash']
         assert task.title == result['title']
         assert task.images == result['images']
+        assert task.image_size == result['image_size']
         assert task.timestamp == result['timestamp']
+        assert task.info == {'title': 'page title'}
@@ -1,6 +1,14 @@
 # -*- coding: utf-8 -*-
+import datetime
+import io
+import json
+
 from unittest import mock
 
+import mongoengine
+import pytest
+
+from artexinweb import settings
 from artexinweb.models import Job, Task
 from artexinweb.tests.base import BaseMongoTestCase
 
@@ -39,7 +47,9 @@ class TestJobModel(BaseMongoTestCase):
         assert job.options['javascript'] is True
 
         dispatch.assert_called_once_with({'type': job.job_type,
-                                          'id': job.job_id})
+                                          'id': job.job_id},
+                                         settings.QUEUE_FETCHABLE_JS,
+                                         Job.PRIORITY_NORMAL)
 
         self.assert_tasks(job, self.fetchable_targets)
 
@@ -55,7 +65,9 @@ class TestJobModel(BaseMongoTestCase):
         assert job.options['origin'] == self.origin
 
         dispatch.assert_called_once_with({'type': job.job_type,
-                                          'id': job.job_id})
+                                          'id': job.job_id},
+                                         settings.QUEUE_STANDALONE,
+                                         Job.PRIORITY_NORMAL)
 
         self.assert_tasks(job, self.standalone_targets)
 
@@ -109,13 +121,179 @@ class TestJobModel(BaseMongoTestCase):
         job.mark_erred()  # jobs are queued by default, so make it erred
         assert job.is_queued is False
 
+        tasks = Task.objects(job_id=job.job_id)
+        tasks.update(set__attempts=3, set__status=Task.FAILED)
         job.retry()
 
         assert job.is_queued is True
+        task = Task.objects.get(job_id=job.job_id)
+        assert task.attempts == 0
+        assert task.is_queued is True
 
         job_data = {'type': job.job_type, 'id': job.job_id}
         # called twice, first when the job is created, next when it's retried
-        dispatch.assert_has_calls([mock.call(job_data), mock.call(job_data)])
+        call = mock.call(job_data,
+                         settings.QUEUE_STANDALONE,
+                         Job.PRIORITY_NORMAL)
+        dispatch.assert_has_calls([call, call])
+
+    @mock.patch('artexinweb.worker.dispatch_many')
+    @mock.patch('artexinweb.worker.dispatch')
+    def test_create_task_dispatch(self, dispatch, dispatch_many):
+        with mock.patch.dict('artexinweb.settings.BOTTLE_CONFIG',
+                             {'artexin.dispatch': Job.DISPATCH_TASK}):
+            job = Job.create(targets=self.fetchable_targets,
+                             job_type=Job.FETCHABLE)
+
+        messages = [{'type': job.job_type,
+                     'id': job.job_id,
+                     'task': str(task.id)}
+                    for task in job.tasks]
+        # all the tasks are sent with a single call
+        dispatch_many.assert_called_once_with(messages,
+                                              settings.QUEUE_FETCHABLE_STATIC,
+                                              Job.PRIORITY_NORMAL,
+                                              delay=None)
+        assert not dispatch.called
+
+    @mock.patch('artexinweb.worker.dispatch')
+    def test_create_priority(self, dispatch):
+        job = Job.create(targets=self.standalone_targets,
+                         job_type=Job.STANDALONE,
+                         priority=Job.PRIORITY_URGENT,
+                         origin=self.origin)
+
+        assert Job.objects.get(job_id=job.job_id).priority == \
+            Job.PRIORITY_URGENT
+        assert 'priority' not in job.options
+        dispatch.assert_called_once_with({'type': job.job_type,
+                                          'id': job.job_id},
+                                         settings.QUEUE_STANDALONE,
+                                         Job.PRIORITY_URGENT)
+
+    def test_get_queue_name(self):
+        job = Job(job_type=Job.FETCHABLE, options={'javascript': True})
+        assert job.get_queue_name() == settings.QUEUE_FETCHABLE_JS
+
+        job = Job(job_type=Job.FETCHABLE, options={'javascript': False})
+        assert job.get_queue_name() == settings.QUEUE_FETCHABLE_STATIC
+
+        job = Job(job_type=Job.STANDALONE, options={})
+        assert job.get_queue_name() == settings.QUEUE_STANDALONE
+
+    @mock.patch('artexinweb.worker.dispatch')
+    def test_get_tasks(self, dispatch):
+        job = Job.create(targets=self.fetchable_targets,
+                         job_type=Job.FETCHABLE)
+        Task.create('b' * 32, 'another job task')
+
+        tasks = list(job.get_tasks())
+        assert [task.target for task in tasks] == self.fetchable_targets
+
+    @mock.patch('artexinweb.worker.dispatch')
+    def test_update_status_force(self, dispatch):
+        job = Job.create(targets=self.fetchable_targets,
+                         job_type=Job.FETCHABLE)
+
+        job.tasks[0].mark_failed("error")
+        assert job.update_status() is False
+        assert job.update_status(force=True) is True
+        assert job.is_erred is True
+
+    @mock.patch('artexinweb.worker.dispatch')
+    def test_update_status(self, dispatch):
+        job = Job.create(targets=self.fetchable_targets,
+                         job_type=Job.FETCHABLE)
+
+        job.tasks[0].mark_finished()
+        assert job.update_status() is False
+        assert job.is_queued is True
+
+        job.tasks[1].mark_failed("error")
+        assert job.update_status() is True
+        assert job.is_erred is True
+
+        job.tasks[1].mark_finished()
+        assert job.update_status() is True
+        assert job.is_finished is True
+
+    @mock.patch('artexinweb.worker.dispatch')
+    def test_update_status_retrying(self, dispatch):
+        job = Job.create(targets=self.fetchable_targets,
+                         job_type=Job.FETCHABLE)
+
+        job.tasks[0].mark_finished()
+        job.tasks[1].mark_retrying("timeout")
+        assert job.update_status(force=True) is False
+        assert job.is_queued is True
+
+    @mock.patch('artexinweb.worker.dispatch')
+    def test_schedule_tasks_delay(self, dispatch):
+        job = Job.create(targets=self.fetchable_targets,
+                         job_type=Job.FETCHABLE)
+        dispatch.reset_mock()
+
+        job.schedule_tasks(Task.objects(id=job.tasks[1].id), delay=10)
+
+        dispatch.assert_called_once_with({'type': job.job_type,
+                                          'id': job.job_id,
+                                          'task': str(job.tasks[1].id)},
+                                         settings.QUEUE_FETCHABLE_STATIC,
+                                         Job.PRIORITY_NORMAL,
+                                         delay=10)
+
+    @mock.patch('artexinweb.worker.dispatch')
+    def test_transition_conditional(self, dispatch):
+        job = Job.create(targets=self.standalone_targets,
+                         job_type=Job.STANDALONE,
+                         origin=self.origin)
+
+        assert job.mark_processing(expected=[Job.QUEUED]) is True
+        assert job.mark_processing(expected=[Job.QUEUED]) is False
+
+        job.reload()
+        assert job.is_processing is True
+        assert job.updated >= job.scheduled
+
+    @mock.patch('artexinweb.worker.dispatch')
+    def test_get_page(self, dispatch):
+        jobs = [Job.create(targets=['/srv/media/{0}'.format(i)],
+                           job_type=Job.STANDALONE,
+                           origin=self.origin) for i in range(5)]
+        jobs[0].mark_erred()
+        for job in jobs:
+            job.reload()  # stored update times have millisecond precision
+
+        expected = sorted(jobs,
+                          key=lambda job: (job.updated, job.job_id),
+                          reverse=True)
+        expected_ids = [job.job_id for job in expected]
+
+        (page, cursor) = Job.get_page(page_size=2)
+        assert [job.job_id for job in page] == expected_ids[:2]
+        assert page[0].tasks == []  # not loaded
+
+        (page, cursor) = Job.get_page(cursor=cursor, page_size=2)
+        assert [job.job_id for job in page] == expected_ids[2:4]
+
+        (page, cursor) = Job.get_page(cursor=cursor, page_size=2)
+        assert [job.job_id for job in page] == expected_ids[4:]
+        assert cursor is None
+
+        (page, cursor) = Job.get_page(status=Job.ERRED)
+        assert [job.job_id for job in page] == [jobs[0].job_id]
+        assert cursor is None
+
+    def test_parse_cursor(self):
+        job = Job(job_id='a' * 32,
+                  updated=datetime.datetime(2015, 3, 1, 12, 0, 0, 123000))
+        assert Job.parse_cursor(job.cursor) == (job.updated, job.job_id)
+
+        for cursor in ('invalid', 'abc.' + 'a' * 32, '123.job_id',
+                       '9' * 30 + '.' + 'a' * 32,
+                       '-' + '9' * 15 + '.' + 'a' * 32):
+            with pytest.raises(ValueError):
+                Job.parse_cursor(cursor)
 
     def test_is_valid_type(self):
         assert Job.is_valid_type(Job.STANDALONE) is True
@@ -137,6 +315,50 @@ class TestTaskModel(BaseMongoTestCase):
         assert task.target == self.task_target
         assert task.status == Task.QUEUED
 
+    def test_create_many(self):
+        targets = ['target_{0}'.format(i) for i in range(5)]
+
+        queryset_cls = mongoengine.queryset.QuerySet
+        with mock.patch.object(queryset_cls, 'insert',
+                               autospec=True,
+                               side_effect=queryset_cls.insert) as insert:
+            tasks = Task.create_many(self.job_id, targets)
+
+        assert insert.call_count == 1
+        assert [task.target for task in tasks] == targets
+        assert all(task.id is not None for task in tasks)
+        assert Task.objects(job_id=self.job_id).count() == len(targets)
+
+    def test_create_many_task_fields(self):
+        task_fields = {'target_1': {'source_md5': 'b' * 32, 'verified': True}}
+
+        tasks = Task.create_many(self.job_id,
+                                 ['target_0', 'target_1'],
+                                 task_fields)
+
+        stored = dict((task.target, Task.objects.get(id=task.id))
+                      for task in tasks)
+        assert stored['target_0'].verified is False
+        assert stored['target_0'].source_md5 is None
+        assert stored['target_1'].verified is True
+        assert stored['target_1'].source_md5 == 'b' * 32
+
+    def test_create_many_invalid(self):
+        with pytest.raises(mongoengine.ValidationError):
+            Task.create_many('invalid_job_id', [self.task_target])
+
+        assert Task.objects.count() == 0
+
+    def test_count_statuses(self):
+        tasks = Task.create_many(self.job_id, ['a', 'b', 'c'])
+        Task.create('b' * 32, 'another job task')
+        tasks[0].mark_failed("error")
+        tasks[1].mark_finished()
+
+        assert Task.count_statuses(self.job_id) == {Task.QUEUED: 1,
+                                                    Task.FAILED: 1,
+                                                    Task.FINISHED: 1}
+
     def test_mark_queued(self):
         task = Task.create(self.job_id, self.task_target)
 
@@ -153,6 +375,58 @@ class TestTaskModel(BaseMongoTestCase):
         task.mark_processing()
         assert task.is_processing is True
 
+    def test_mark_processing_lease(self):
+        task = Task.create(self.job_id, self.task_target)
+        config = {'artexin.lease_duration': '60'}
+
+        with mock.patch.dict('artexinweb.settings.BOTTLE_CONFIG', config):
+            task.mark_processing()
+            task.mark_processing()
+
+        stored = Task.objects.get(id=task.id)
+        assert stored.attempts == 2
+        lease = stored.lease_expires - datetime.datetime.utcnow()
+        assert datetime.timedelta(0) < lease <= datetime.timedelta(seconds=60)
+
+    def test_mark_processing_stale_attempts(self):
+        task = Task.create(self.job_id, self.task_target)
+        # another worker started processing the task in the meantime
+        Task.objects(id=task.id).update_one(set__attempts=2)
+
+        assert task.attempts == 0
+        assert task.mark_processing() is True
+        assert task.attempts == 3
+        assert Task.objects.get(id=task.id).attempts == 3
+
+    def test_renew_lease(self):
+        task = Task.create(self.job_id, self.task_target)
+        assert task.renew_lease() is False
+
+        task.mark_processing()
+        expired = datetime.datetime(2000, 1, 1)
+        Task.objects(id=task.id).update_one(set__lease_expires=expired)
+
+        assert task.renew_lease() is True
+        assert Task.objects.get(id=task.id).lease_expires > expired
+
+    def test_get_max_attempts(self):
+        with mock.patch.dict('artexinweb.settings.BOTTLE_CONFIG',
+                             {'artexin.max_attempts': '0'}):
+            assert Task.get_max_attempts() == 1
+
+    def test_get_expired(self):
+        expired = Task.create(self.job_id, self.task_target)
+        expired.mark_processing()
+        alive = Task.create(self.job_id, self.task_target)
+        alive.mark_processing()
+        Task.create(self.job_id, self.task_target)
+
+        now = datetime.datetime.utcnow() + datetime.timedelta(seconds=1)
+        Task.objects(id=expired.id).update_one(set__lease_expires=now)
+        now += datetime.timedelta(seconds=1)
+
+        assert [task.id for task in Task.get_expired(now)] == [expired.id]
+
     def test_mark_failed(self):
         task = Task.create(self.job_id, self.task_target)
 
@@ -169,3 +443,89 @@ class TestTaskModel(BaseMongoTestCase):
         task.mark_finished()
         assert task.is_finished is True
         assert task.notes == ''
+
+    def test_mark_finished_partial_update(self):
+        task = Task.create(self.job_id, self.task_target)
+        task.size = 1024
+        task.md5 = 'b' * 32
+        task.title = 'title'
+
+        with mock.patch.object(Task, 'save') as save:
+            assert task.mark_finished() is True
+            assert not save.called
+
+        stored = Task.objects.get(id=task.id)
+        assert stored.is_finished is True
+        assert stored.size == 1024
+        assert stored.md5 == 'b' * 32
+        assert stored.title == 'title'
+        assert stored.updated is not None
+
+    def test_mark_failed_conditional(self):
+        task = Task.create(self.job_id, self.task_target)
+        task.mark_processing()
+
+        # another worker already finished it
+        Task.objects(id=task.id).update_one(set__status=Task.FINISHED)
+
+        assert task.mark_failed("error", expected=[Task.PROCESSING]) is False
+        assert task.is_failed is False
+        assert Task.objects.get(id=task.id).is_finished is True
+
+    def test_mark_finished_invalid_result(self):
+        task = Task.create(self.job_id, self.task_target)
+        task.md5 = 'invalid'
+
+        with pytest.raises(mongoengine.ValidationError):
+            task.mark_finished()
+
+        assert Task.objects.get(id=task.id).is_queued is True
+
+    @mock.patch('artexinweb.utils.read_from_zip')
+    def test_get_info_stored(self, read_from_zip):
+        task = Task.create(self.job_id, self.task_target)
+        Task.objects(id=task.id).update_one(set__info={'title': 'stored'})
+
+        task = Task.objects.get(id=task.id)
+
+        assert task.get_info() == {'title': 'stored'}
+        assert not read_from_zip.called
+
+    @mock.patch('artexinweb.utils.read_from_zip')
+    def test_get_info_from_zipball(self, read_from_zip):
+        read_from_zip.return_value = io.BytesIO(b'{"title": "zipped"}')
+        task = Task.create(self.job_id, self.task_target)
+        task.md5 = 'b' * 32
+        task.save()
+
+        with mock.patch.dict('artexinweb.settings.BOTTLE_CONFIG',
+                             {'artexin.out_dir': '/srv/zipballs'}):
+            assert task.get_info() == {'title': 'zipped'}
+            zipball_path = task.zipball_path
+
+        read_from_zip.assert_called_once_with(zipball_path,
+                                              '{0}/info.json'.format(task.md5))
+        assert Task.objects.get(id=task.id).info == {'title': 'zipped'}
+
+    @mock.patch('artexinweb.utils.replace_in_zip')
+    def test_update_info(self, replace_in_zip):
+        (task, sharing, other) = Task.create_many(self.job_id,
+                                                  ['a', 'b', 'c'])
+        Task.objects(id__in=[task.id, sharing.id]).update(set__md5='b' * 32)
+        Task.objects(id=other.id).update(set__md5='c' * 32,
+                                         set__info={'title': 'other'})
+        task.md5 = 'b' * 32
+        info = {'title': 'edited', 'language': 'en'}
+
+        with mock.patch.dict('artexinweb.settings.BOTTLE_CONFIG',
+                             {'artexin.out_dir': '/srv/zipballs'}):
+            task.update_info(info)
+            zipball_path = task.zipball_path
+
+        replacements = {'{0}/info.json'.format(task.md5): json.dumps(info)}
+        replace_in_zip.assert_called_once_with(zipball_path, **replacements)
+        assert task.info == info
+        assert Task.objects.get(id=task.id).info == info
+        # tasks sharing the zipball have their copies updated too
+        assert Task.objects.get(id=sharing.id).info == info
+        assert Task.objects.get(id=other.id).info == {'title': 'other'}
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+import datetime
+
+from artexinweb.models import Counter, Job, Task, collect_stats
+from artexinweb.tests.base import BaseMongoTestCase
+
+
+class TestCounterModel(BaseMongoTestCase):
+
+    def test_increment(self):
+        assert Counter.get_value('test') == 0
+
+        Counter.increment('test')
+        Counter.increment('test', 2)
+
+        assert Counter.get_value('test') == 3
+
+
+class TestCollectStats(BaseMongoTestCase):
+
+    def test_collect_stats(self):
+        now = datetime.datetime.utcnow()
+        tasks = Task.create_many('a' * 32, ['a', 'b', 'c', 'd'])
+        Job(job_id='a' * 32,
+            job_type=Job.FETCHABLE,
+            status=Job.ERRED,
+            scheduled=now,
+            tasks=tasks).save()
+
+        tasks[0].mark_failed("error")
+        tasks[1].mark_finished()
+        tasks[2].mark_finished()
+        Task.objects(id=tasks[2].id).update_one(
+            set__updated=now - datetime.timedelta(hours=2)
+        )
+
+        stats = collect_stats()
+
+        assert stats['jobs'] == {Job.QUEUED: 0,
+                                 Job.PROCESSING: 0,
+                                 Job.ERRED: 1,
+                                 Job.FINISHED: 0}
+        assert stats['tasks'] == {Task.QUEUED: 1,
+                                  Task.PROCESSING: 0,
+                                  Task.RETRYING: 0,
+                                  Task.FAILED: 1,
+                                  Task.FINISHED: 2}
+        assert stats['finished_last_hour'] == 1
+        assert stats['finished_last_day'] == 2
+
+    def test_collect_stats_empty(self):
+        stats = collect_stats()
+
+        assert set(stats['tasks'].values()) == {0}
+        assert stats['finished_last_hour'] == 0
+        assert stats['finished_last_day'] == 0
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+import json
+
+from unittest import mock
+
+import redis
+
+from artexinweb import cache
+
+
+@mock.patch('artexinweb.cache.get_connection')
+def test_get_or_set_hit(get_connection):
+    connection = get_connection.return_value
+    connection.get.return_value = json.dumps({'a': 1}).encode('utf-8')
+    func = mock.Mock()
+
+    assert cache.get_or_set('key', 10, func) == {'a': 1}
+
+    connection.get.assert_called_once_with(cache.KEY_PREFIX + 'key')
+    assert not func.called
+    assert not connection.setex.called
+
+
+@mock.patch('artexinweb.cache.get_connection')
+def test_get_or_set_miss(get_connection):
+    connection = get_connection.return_value
+    connection.get.return_value = None
+    func = mock.Mock(return_value={'a': 1})
+
+    assert cache.get_or_set('key', 10, func) == {'a': 1}
+
+    func.assert_called_once_with()
+    connection.setex.assert_called_once_with(cache.KEY_PREFIX + 'key',
+                                             10,
+                                             json.dumps({'a': 1}))
+
+
+@mock.patch('artexinweb.cache.get_connection')
+def test_get_or_set_unavailable(get_connection):
+    connection = get_connection.return_value
+    connection.get.side_effect = redis.ConnectionError()
+    func = mock.Mock(return_value={'a': 1})
+
+    assert cache.get_or_set('key', 10, func) == {'a': 1}
+    func.assert_called_once_with()
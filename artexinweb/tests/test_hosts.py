@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+import http.client
+
+from unittest import mock
+
+import pytest
+
+from artexinweb import hosts
+
+
+def test_interleave():
+    items = ['a1', 'a2', 'a3', 'b1', 'c1', 'c2']
+    result = hosts.interleave(items, key=lambda item: item[0])
+    assert result == ['a1', 'b1', 'c1', 'a2', 'c2', 'a3']
+
+
+def test_get_host():
+    host = hosts.get_host('http://EN.Wikipedia.org/wiki/')
+    assert host == 'en.wikipedia.org'
+
+
+class TestHost(object):
+
+    def make_connection(self, will_close=False):
+        connection = mock.Mock()
+        response = connection.getresponse.return_value
+        response.status = 200
+        response.msg = {'ETag': 'test'}
+        response.will_close = will_close
+        return connection
+
+    @mock.patch('time.sleep')
+    @mock.patch('time.monotonic')
+    def test_slot_delay(self, monotonic, sleep):
+        host = hosts.Host('http', 'target.com', concurrency=1, delay=2)
+
+        monotonic.return_value = 10
+        with host.slot():
+            pass
+        assert not sleep.called
+
+        monotonic.return_value = 10.5
+        with host.slot():
+            pass
+        sleep.assert_called_once_with(1.5)
+
+    def test_request_reuses_connection(self):
+        connection = self.make_connection()
+        host = hosts.Host('http', 'target.com', concurrency=1, delay=0)
+        connection_cls = mock.Mock(return_value=connection)
+
+        with mock.patch.dict(host.connection_classes, http=connection_cls):
+            assert host.request('HEAD', '/', {}, 5) == (200, {'ETag': 'test'})
+            host.request('HEAD', '/other', {}, 5)
+
+        connection_cls.assert_called_once_with('target.com', timeout=5)
+        assert connection.request.call_count == 2
+        assert not connection.close.called
+
+    def test_request_reused_connection_timeout(self):
+        connection = self.make_connection()
+        host = hosts.Host('http', 'target.com', concurrency=1, delay=0)
+        host.idle_connections.append(connection)
+
+        host.request('HEAD', '/', {}, 7)
+
+        assert connection.timeout == 7
+        connection.sock.settimeout.assert_called_once_with(7)
+
+    def test_request_closed_connection(self):
+        connection = self.make_connection(will_close=True)
+        host = hosts.Host('http', 'target.com', concurrency=1, delay=0)
+        connection_cls = mock.Mock(return_value=connection)
+
+        with mock.patch.dict(host.connection_classes, http=connection_cls):
+            host.request('HEAD', '/', {}, 5)
+            host.request('HEAD', '/', {}, 5)
+
+        assert connection_cls.call_count == 2
+        assert connection.close.call_count == 2
+
+    def test_request_user_agent(self):
+        connection = self.make_connection()
+        host = hosts.Host('http', 'target.com', concurrency=1, delay=0)
+        connection_cls = mock.Mock(return_value=connection)
+
+        with mock.patch.dict(host.connection_classes, http=connection_cls):
+            host.request('HEAD', '/', {}, 5)
+            host.request('HEAD', '/', {'User-Agent': 'custom'}, 5)
+
+        calls = connection.request.call_args_list
+        assert calls[0][1]['headers'] == {
+            'User-Agent': hosts.DEFAULT_USER_AGENT
+        }
+        assert calls[1][1]['headers'] == {'User-Agent': 'custom'}
+
+    def test_request_stale_connection(self):
+        stale = self.make_connection()
+        stale.getresponse.side_effect = http.client.BadStatusLine('')
+        fresh = self.make_connection()
+        host = hosts.Host('http', 'target.com', concurrency=1, delay=0)
+        host.idle_connections.append(stale)
+        connection_cls = mock.Mock(return_value=fresh)
+
+        with mock.patch.dict(host.connection_classes, http=connection_cls):
+            assert host.request('HEAD', '/', {}, 5) == (200, {'ETag': 'test'})
+
+        stale.close.assert_called_once_with()
+        assert fresh.request.call_count == 1
+        assert host.idle_connections == [fresh]
+
+    def test_request_new_connection_not_retried(self):
+        connection = self.make_connection()
+        connection.getresponse.side_effect = ConnectionResetError()
+        host = hosts.Host('http', 'target.com', concurrency=1, delay=0)
+        connection_cls = mock.Mock(return_value=connection)
+
+        with mock.patch.dict(host.connection_classes, http=connection_cls):
+            with pytest.raises(ConnectionResetError):
+                host.request('HEAD', '/', {}, 5)
+
+        assert connection_cls.call_count == 1
+
+    def test_request_range_ignored(self):
+        connection = self.make_connection()
+        host = hosts.Host('http', 'target.com', concurrency=1, delay=0)
+        connection_cls = mock.Mock(return_value=connection)
+
+        with mock.patch.dict(host.connection_classes, http=connection_cls):
+            host.request('GET', '/', {'Range': 'bytes=0-0'}, 5)
+
+        response = connection.getresponse.return_value
+        assert not response.read.called
+        connection.close.assert_called_once_with()
+        assert host.idle_connections == []
+
+    @mock.patch('time.sleep')
+    def test_slot_delay_releases_lock(self, sleep):
+        host = hosts.Host('http', 'target.com', concurrency=2, delay=2)
+
+        def assert_unlocked(wait):
+            # the idle connections are accessible while waiting
+            assert host.lock.acquire(blocking=False) is True
+            host.lock.release()
+
+        sleep.side_effect = assert_unlocked
+
+        with host.slot():
+            pass
+        with host.slot():
+            pass
+
+        assert sleep.called
+
+    def test_request_failure(self):
+        connection = self.make_connection()
+        connection.getresponse.side_effect = OSError()
+        host = hosts.Host('http', 'target.com', concurrency=1, delay=0)
+        connection_cls = mock.Mock(return_value=connection)
+
+        with mock.patch.dict(host.connection_classes, http=connection_cls):
+            with pytest.raises(OSError):
+                host.request('HEAD', '/', {}, 5)
+
+        connection.close.assert_called_once_with()
+        assert host.idle_connections == []
+
+
+class TestHostPool(object):
+
+    def test_get(self):
+        pool = hosts.HostPool()
+        host = pool.get('http://target.com/page')
+
+        assert host is pool.get('http://TARGET.com/other')
+        assert host is not pool.get('https://target.com/page')
+
+    @mock.patch('artexinweb.hosts.Host.request')
+    def test_request_redirect(self, request):
+        request.side_effect = [(301, {'Location': '/moved?q=1'}),
+                               (200, {})]
+        pool = hosts.HostPool()
+
+        result = pool.request('HEAD', 'http://target.com/page', {}, 5)
+
+        assert result == (200, {})
+        request.assert_has_calls([mock.call('HEAD', '/page', {}, 5),
+                                  mock.call('HEAD', '/moved?q=1', {}, 5)])
+
+    @mock.patch('artexinweb.hosts.Host.slot', autospec=True)
+    @mock.patch('artexinweb.hosts.Host.request')
+    def test_request_redirect_slots(self, request, slot):
+        request.side_effect = [(302, {'Location': 'http://other.com/page'}),
+                               (200, {})]
+        pool = hosts.HostPool()
+
+        pool.request('HEAD', 'http://target.com/page', {}, 5)
+
+        # the slot of each host is taken for it's own request
+        slot.assert_has_calls([mock.call(pool.get('http://target.com/')),
+                               mock.call(pool.get('http://other.com/'))],
+                              any_order=True)
+        assert slot.call_count == 2
+
+    @mock.patch('artexinweb.hosts.Host.request')
+    def test_request_too_many_redirects(self, request):
+        request.return_value = (302, {'Location': '/loop'})
+        pool = hosts.HostPool()
+
+        with pytest.raises(http.client.HTTPException):
+            pool.request('HEAD', 'http://target.com/page', {}, 5)
+
+        assert request.call_count == hosts.MAX_REDIRECTS + 1
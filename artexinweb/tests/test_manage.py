@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+from unittest import mock
+
+from artexinweb import manage, settings
+from artexinweb.models import Job, Task
+from artexinweb.tests.base import BaseMongoTestCase
+
+
+class TestManage(BaseMongoTestCase):
+
+    def test_check_indexes_missing(self):
+        assert manage.check_indexes() == 1
+
+    def test_ensure_indexes(self):
+        assert manage.ensure_indexes() == 0
+        assert manage.check_indexes() == 0
+
+        for model in (Job, Task):
+            assert model.compare_indexes() == {'missing': [], 'extra': []}
+
+    @mock.patch('mongoengine.connect')
+    @mock.patch('artexinweb.manage.ensure_indexes')
+    def test_main(self, ensure_indexes, connect):
+        ensure_indexes.return_value = 0
+        config = {'database.url': 'mongodb://localhost/test'}
+
+        with mock.patch.dict('artexinweb.settings.BOTTLE_CONFIG', config):
+            with mock.patch.dict(manage.COMMANDS,
+                                 ensure_indexes=ensure_indexes):
+                assert manage.main(['ensure_indexes']) == 0
+
+        connect.assert_called_once_with('', host=config['database.url'])
+        ensure_indexes.assert_called_once_with()
+
+    @mock.patch('artexinweb.utils.save_locales')
+    def test_save_locales(self, save_locales):
+        assert manage.save_locales() == 0
+        save_locales.assert_called_once_with(settings.LOCALES_PATH)
+
+    @mock.patch('artexinweb.reaper.reclaim')
+    def test_reclaim_tasks(self, reclaim):
+        reclaim.return_value = (1, 0)
+        assert manage.reclaim_tasks() == 0
+        reclaim.assert_called_once_with()
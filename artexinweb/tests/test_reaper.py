@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+import datetime
+
+from unittest import mock
+
+from artexinweb import reaper, settings
+from artexinweb.models import Job, Task
+from artexinweb.tests.base import BaseMongoTestCase
+
+
+class TestReaper(BaseMongoTestCase):
+
+    targets = ['http://en.wikipedia.org/wiki/Prime_factor',
+               'http://en.wikipedia.org/wiki/Integer_factorization',
+               'http://en.wikipedia.org/wiki/Prime_number']
+
+    def expire(self, task, attempts):
+        expired = datetime.datetime.utcnow() - datetime.timedelta(seconds=1)
+        Task.objects(id=task.id).update_one(set__status=Task.PROCESSING,
+                                            set__lease_expires=expired,
+                                            set__attempts=attempts)
+
+    @mock.patch('artexinweb.worker.dispatch_many')
+    @mock.patch('artexinweb.worker.dispatch')
+    def test_reclaim(self, dispatch, dispatch_many):
+        job = Job.create(targets=self.targets, job_type=Job.FETCHABLE)
+        job.mark_processing()
+        (crashed, exhausted, never_started) = job.tasks
+        self.expire(crashed, 1)
+        self.expire(exhausted, 3)
+        dispatch.reset_mock()
+
+        with mock.patch.dict('artexinweb.settings.BOTTLE_CONFIG',
+                             {'artexin.max_attempts': '3'}):
+            assert reaper.reclaim() == (1, 1)
+
+        assert Task.objects.get(id=crashed.id).is_queued is True
+        assert Task.objects.get(id=exhausted.id).is_failed is True
+        messages = [{'type': job.job_type,
+                     'id': job.job_id,
+                     'task': str(task.id)}
+                    for task in (crashed, never_started)]
+        dispatch_many.assert_called_once_with(messages,
+                                              settings.QUEUE_FETCHABLE_STATIC,
+                                              Job.PRIORITY_NORMAL,
+                                              delay=None)
+        assert not dispatch.called
+        assert Job.objects.get(job_id=job.job_id).is_processing is True
+
+    @mock.patch('artexinweb.worker.dispatch_many')
+    def test_reclaim_task_dispatch(self, dispatch_many):
+        with mock.patch.dict('artexinweb.settings.BOTTLE_CONFIG',
+                             {'artexin.dispatch': Job.DISPATCH_TASK}):
+            job = Job.create(targets=self.targets, job_type=Job.FETCHABLE)
+            job.mark_processing()
+            crashed = job.tasks[0]
+            self.expire(crashed, 1)
+            dispatch_many.reset_mock()
+
+            assert reaper.reclaim() == (1, 0)
+
+        # the never started tasks already have their messages pending
+        dispatch_many.assert_called_once_with([{'type': job.job_type,
+                                                'id': job.job_id,
+                                                'task': str(crashed.id)}],
+                                              settings.QUEUE_FETCHABLE_STATIC,
+                                              Job.PRIORITY_NORMAL,
+                                              delay=None)
+
+    @mock.patch('artexinweb.worker.dispatch_many')
+    @mock.patch('artexinweb.worker.dispatch')
+    def test_reclaim_last_task_failed(self, dispatch, dispatch_many):
+        job = Job.create(targets=self.targets[:1], job_type=Job.FETCHABLE)
+        job.mark_processing()
+        self.expire(job.tasks[0], 3)
+        dispatch.reset_mock()
+
+        assert reaper.reclaim() == (0, 1)
+
+        assert not dispatch.called
+        assert Job.objects.get(job_id=job.job_id).is_erred is True
+
+    @mock.patch('artexinweb.worker.dispatch')
+    def test_reclaim_alive(self, dispatch):
+        job = Job.create(targets=self.targets, job_type=Job.FETCHABLE)
+        job.tasks[0].mark_processing()
+        dispatch.reset_mock()
+
+        assert reaper.reclaim() == (0, 0)
+
+        assert Task.objects.get(id=job.tasks[0].id).is_processing is True
+        assert not dispatch.called
+
+    @mock.patch('artexinweb.worker.dispatch_many')
+    @mock.patch('artexinweb.worker.dispatch')
+    def test_reclaim_lost_retry(self, dispatch, dispatch_many):
+        job = Job.create(targets=self.targets[:2], job_type=Job.FETCHABLE)
+        (lost, waiting) = job.tasks
+        lost.mark_retrying("timeout")
+        waiting.mark_retrying("timeout")
+        updated = datetime.datetime.utcnow() - datetime.timedelta(seconds=100)
+        Task.objects(id=lost.id).update_one(set__updated=updated)
+
+        config = {'artexin.max_retry_delay': '30',
+                  'artexin.lease_duration': '30'}
+        with mock.patch.dict('artexinweb.settings.BOTTLE_CONFIG', config):
+            assert reaper.reclaim() == (1, 0)
+
+        assert Task.objects.get(id=lost.id).is_queued is True
+        assert Task.objects.get(id=waiting.id).is_retrying is True
+        dispatch_many.assert_called_once_with([{'type': job.job_type,
+                                                'id': job.job_id,
+                                                'task': str(lost.id)}],
+                                              settings.QUEUE_FETCHABLE_STATIC,
+                                              Job.PRIORITY_NORMAL,
+                                              delay=None)
+
+    @mock.patch('artexinweb.worker.dispatch_many')
+    @mock.patch('artexinweb.worker.dispatch')
+    def test_reclaim_stalled_job(self, dispatch, dispatch_many):
+        stalled = Job.create(targets=self.targets[:2], job_type=Job.FETCHABLE)
+        stalled.tasks[0].mark_finished()
+        leased = Job.create(targets=self.targets[2:], job_type=Job.FETCHABLE)
+        leased.tasks[0].mark_processing()
+        updated = datetime.datetime.utcnow() - datetime.timedelta(seconds=100)
+        for job in (stalled, leased):
+            Job.objects(job_id=job.job_id).update_one(
+                set__status=Job.PROCESSING,
+                set__updated=updated)
+
+        config = {'artexin.lease_duration': '30'}
+        with mock.patch.dict('artexinweb.settings.BOTTLE_CONFIG', config):
+            assert reaper.reclaim() == (0, 0)
+
+        assert Job.objects.get(job_id=stalled.job_id).is_queued is True
+        assert Job.objects.get(job_id=leased.job_id).is_processing is True
+        message = {'type': stalled.job_type,
+                   'id': stalled.job_id,
+                   'task': str(stalled.tasks[1].id)}
+        dispatch_many.assert_called_once_with([message],
+                                              settings.QUEUE_FETCHABLE_STATIC,
+                                              Job.PRIORITY_NORMAL,
+                                              delay=None)
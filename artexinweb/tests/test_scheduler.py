@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+import json
+
+from unittest import mock
+
+from artexinweb import scheduler
+
+
+@mock.patch('artexinweb.scheduler.get_aging')
+def test_get_score(get_aging):
+    get_aging.return_value = 60
+
+    assert scheduler.get_score(0, timestamp=1000) == 1000
+    assert scheduler.get_score(2, timestamp=1000) == 880
+    # a low priority message waiting long enough is served before an urgent
+    # one sent later
+    assert scheduler.get_score(-1, timestamp=1000) < \
+        scheduler.get_score(2, timestamp=1181)
+
+
+@mock.patch('artexinweb.scheduler.get_score')
+@mock.patch('artexinweb.cache.get_connection')
+def test_push(get_connection, get_score):
+    get_score.return_value = 880
+    message = {'type': 'test', 'id': 'job_id'}
+
+    scheduler.push('test_queue', message, 2)
+
+    get_score.assert_called_once_with(2)
+    connection = get_connection.return_value
+    connection.execute_command.assert_called_once_with(
+        'ZADD',
+        scheduler.KEY_PREFIX + 'test_queue',
+        880,
+        json.dumps(message, sort_keys=True))
+
+
+@mock.patch('artexinweb.cache.get_connection')
+def test_pop(get_connection):
+    message = {'type': 'test', 'id': 'job_id'}
+    script = get_connection.return_value.register_script.return_value
+    script.return_value = json.dumps(message).encode('utf-8')
+
+    assert scheduler.pop('test_queue') == message
+
+    script.assert_called_once_with(keys=[scheduler.KEY_PREFIX + 'test_queue'])
+
+
+@mock.patch('artexinweb.cache.get_connection')
+def test_pop_empty(get_connection):
+    script = get_connection.return_value.register_script.return_value
+    script.return_value = None
+
+    assert scheduler.pop('test_queue') is None
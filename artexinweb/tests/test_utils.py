@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import io
+import os
+import stat
+import zipfile
+
+from unittest import mock
+
+import pytest
+
+from artexinweb import exceptions, utils
+
+
+class UnseekableWriter(io.RawIOBase):
+    """Makes ``zipfile`` write data descriptors after the members."""
+
+    def __init__(self, path):
+        self.file = open(path, 'wb')
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        return self.file.write(data)
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+        super(UnseekableWriter, self).close()
+
+
+@pytest.fixture
+def zip_path(tmpdir):
+    path = str(tmpdir.join('test.zip'))
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr('md5/index.html', b'<html>' + b'a' * 10000 + b'</html>')
+        zf.writestr('md5/info.json', b'{"title": "old"}')
+        zf.writestr('md5/image.png', b'\x89PNG' + os.urandom(1000))
+    os.chmod(path, 0o644)
+    return path
+
+
+def read_all(path):
+    with zipfile.ZipFile(path) as zf:
+        assert zf.testzip() is None
+        return dict((name, zf.read(name)) for name in zf.namelist())
+
+
+def test_replace_in_zip(zip_path):
+    original = read_all(zip_path)
+
+    utils.replace_in_zip(zip_path, **{'md5/info.json': '{"title": "new"}'})
+
+    result = read_all(zip_path)
+    assert result['md5/info.json'] == b'{"title": "new"}'
+    assert result['md5/index.html'] == original['md5/index.html']
+    assert result['md5/image.png'] == original['md5/image.png']
+    assert stat.S_IMODE(os.stat(zip_path).st_mode) == 0o644
+    assert os.listdir(os.path.dirname(zip_path)) == ['test.zip']
+
+
+@mock.patch('artexinweb.utils.IS_RAW_ZIP_COPY_SUPPORTED', False)
+def test_replace_in_zip_unsupported_raw_copy(zip_path):
+    original = read_all(zip_path)
+
+    utils.replace_in_zip(zip_path, **{'md5/info.json': '{"title": "new"}'})
+
+    result = read_all(zip_path)
+    assert result['md5/info.json'] == b'{"title": "new"}'
+    assert result['md5/index.html'] == original['md5/index.html']
+    assert result['md5/image.png'] == original['md5/image.png']
+
+
+def test_replace_in_zip_no_recompression(zip_path):
+    with mock.patch('zlib.compressobj') as compressobj:
+        with mock.patch('zlib.decompressobj') as decompressobj:
+            utils.replace_in_zip(zip_path, **{'md5/info.json': '{}'})
+
+    assert not compressobj.called
+    assert not decompressobj.called
+
+
+def test_remove_from_zip(zip_path):
+    utils.remove_from_zip(zip_path, 'md5/image.png')
+
+    assert sorted(read_all(zip_path)) == ['md5/index.html', 'md5/info.json']
+
+
+def test_remove_from_zip_data_descriptors(tmpdir):
+    path = str(tmpdir.join('stream.zip'))
+    with zipfile.ZipFile(UnseekableWriter(path), 'w',
+                         zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr('first.txt', b'first' * 100)
+        zf.writestr('second.txt', b'second' * 100)
+        zf.writestr('third.txt', b'third' * 100)
+
+    with zipfile.ZipFile(path) as zf:
+        assert zf.getinfo('first.txt').flag_bits & utils.DATA_DESCRIPTOR_FLAG
+
+    utils.remove_from_zip(path, 'second.txt')
+
+    assert read_all(path) == {'first.txt': b'first' * 100,
+                              'third.txt': b'third' * 100}
+
+
+def test_rewrite_zip_failure(zip_path):
+    with open(zip_path, 'rb') as original:
+        original_data = original.read()
+
+    with mock.patch('artexinweb.utils.copy_zip_members',
+                    side_effect=zipfile.BadZipFile()):
+        with pytest.raises(zipfile.BadZipFile):
+            utils.replace_in_zip(zip_path, **{'md5/info.json': '{}'})
+
+    with open(zip_path, 'rb') as result:
+        assert result.read() == original_data
+    assert os.listdir(os.path.dirname(zip_path)) == ['test.zip']
+
+
+def test_save_upload(tmpdir):
+    data = os.urandom(1000)
+    dest_path = str(tmpdir.join('upload.zip'))
+
+    result = utils.save_upload(io.BytesIO(data), dest_path, chunk_size=64)
+
+    assert result == hashlib.md5(data).hexdigest()
+    with open(dest_path, 'rb') as dest_file:
+        assert dest_file.read() == data
+
+
+def test_save_upload_too_large(tmpdir):
+    dest_path = str(tmpdir.join('upload.zip'))
+
+    with pytest.raises(exceptions.UploadTooLarge):
+        utils.save_upload(io.BytesIO(b'a' * 1000), dest_path, max_size=999)
+
+    assert not os.path.exists(dest_path)
+
+
+@pytest.mark.parametrize('workers', [1, 3])
+def test_unzip(tmpdir, workers):
+    path = str(tmpdir.join('bundle.zip'))
+    members = {'index.html': b'<html></html>',
+               'static/': b'',
+               'static/style.css': b'body {}',
+               'static/img/logo.png': b'\x89PNG' + os.urandom(100),
+               '../escape.txt': b'escape'}
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for (name, data) in sorted(members.items()):
+            zf.writestr(name, data)
+
+    dest_dir = str(tmpdir.mkdir('dest'))
+    utils.unzip(path, dest_dir, workers=workers)
+
+    extracted = dict()
+    for (dirpath, dirnames, filenames) in os.walk(dest_dir):
+        for filename in filenames:
+            filepath = os.path.join(dirpath, filename)
+            with open(filepath, 'rb') as extracted_file:
+                relpath = os.path.relpath(filepath, dest_dir)
+                extracted[relpath] = extracted_file.read()
+
+    assert extracted['index.html'] == members['index.html']
+    assert extracted['escape.txt'] == members['../escape.txt']
+    assert len(extracted) == 4
+    assert not os.path.exists(str(tmpdir.join('escape.txt')))
+
+
+def test_save_locales(tmpdir):
+    cache_path = str(tmpdir.join('locales.json'))
+    locales = [('de', 'German (Deutsch)'), ('en', 'English')]
+
+    with mock.patch('artexinweb.utils.collect_locales') as collect_locales:
+        collect_locales.return_value = locales
+        utils.save_locales(cache_path)
+        assert utils.get_locales(cache_path) == locales
+        assert utils.get_locales(cache_path) == locales
+
+    collect_locales.assert_called_once_with()
+
+
+def test_get_locales_no_cache_file(tmpdir):
+    cache_path = str(tmpdir.join('missing.json'))
+    locales = [('en', 'English')]
+
+    with mock.patch('artexinweb.utils.collect_locales') as collect_locales:
+        collect_locales.return_value = locales
+        assert utils.get_locales(cache_path) == locales
+        assert utils.get_locales(cache_path) == locales
+
+    collect_locales.assert_called_once_with()
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+from unittest import mock
+
+from artexinweb import handlers, settings, worker
+from artexinweb.decorators import registered
+
+
+@mock.patch.object(worker.load_handlers, 'loaded', False)
+@mock.patch('artexinweb.utils.discover')
+def test_load_handlers(discover):
+    worker.load_handlers()
+    worker.load_handlers()
+
+    discover.assert_called_once_with(handlers)
+
+
+@mock.patch('artexinweb.worker.load_handlers')
+def test_run_handlers(load_handlers):
+    handler_func = mock.Mock()
+
+    with mock.patch.dict(registered.handlers, test=[handler_func]):
+        worker.run_handlers({'type': 'test', 'id': 'job_id'})
+        worker.run_handlers({'type': 'unknown', 'id': 'job_id'})
+
+    handler_func.assert_called_once_with({'id': 'job_id'})
+    assert load_handlers.call_count == 2
+
+
+@mock.patch('artexinweb.scheduler.push')
+def test_dispatch(push):
+    dispatcher = mock.Mock()
+    message = {'type': 'test', 'id': 'job_id'}
+
+    with mock.patch.dict(worker.dispatchers, test_queue=dispatcher):
+        worker.dispatch(message, 'test_queue', 2)
+
+    push.assert_called_once_with('test_queue', message, 2)
+    dispatcher.assert_called_once_with()
+
+
+@mock.patch('artexinweb.scheduler.push')
+def test_dispatch_delay(push):
+    dispatcher = mock.Mock()
+    message = {'type': 'test', 'id': 'job_id'}
+
+    with mock.patch.dict(worker.dispatchers, test_queue=dispatcher):
+        worker.dispatch(message, 'test_queue', 2, delay=30)
+
+    assert not push.called
+    dispatcher.schedule.assert_called_once_with(args=(message, 2), delay=30)
+
+
+@mock.patch('artexinweb.worker.run_handlers')
+@mock.patch('artexinweb.scheduler.pop')
+@mock.patch('artexinweb.scheduler.push')
+def test_dispatcher_delayed_message(push, pop, run_handlers):
+    message = {'type': 'test', 'id': 'job_id'}
+    pop.return_value = message
+    queue = mock.Mock()
+    queue.task.return_value = lambda func: func
+
+    dispatcher = worker.create_dispatcher('test_queue', queue)
+    dispatcher(message, 2)
+
+    push.assert_called_once_with('test_queue', message, 2)
+    pop.assert_called_once_with('test_queue')
+    run_handlers.assert_called_once_with(message)
+
+
+@mock.patch('artexinweb.worker.create_token')
+@mock.patch('artexinweb.cache.get_connection')
+def test_dispatch_many(get_connection, create_token):
+    pipeline = get_connection.return_value.pipeline.return_value
+    create_token.return_value = ('queue_key', b'token')
+    messages = [{'type': 'test', 'id': 'job_id', 'task': str(i)}
+                for i in range(3)]
+
+    with mock.patch('artexinweb.scheduler.push') as push:
+        worker.dispatch_many(messages, 'test_queue', 1)
+
+    push.assert_has_calls([mock.call('test_queue', message, 1,
+                                     pipeline=pipeline)
+                           for message in messages])
+    assert pipeline.lpush.call_args_list == [mock.call('queue_key',
+                                                       b'token')] * 3
+    # a single round trip for all the messages
+    pipeline.execute.assert_called_once_with()
+
+
+def test_create_token():
+    queue_name = settings.QUEUE_STANDALONE
+    (queue_key, token) = worker.create_token(queue_name)
+
+    queue = settings.QUEUES[queue_name]
+    assert queue_key == queue.storage.queue_key
+    task = queue.deserialize_task(token)
+    assert isinstance(task, worker.dispatchers[queue_name].task_class)
+
+
+def test_create_token_huey_04():
+    # huey 0.4 keeps the queue in ``queue.queue`` and serializes tasks with
+    # it's task registry
+    queue = mock.Mock(spec=['queue'])
+    queue.queue.queue_name = 'huey.redis.test_queue'
+    dispatcher = mock.Mock()
+    registry_module = mock.Mock()
+    registry = registry_module.registry
+    registry.get_message_for_task.return_value = b'token'
+
+    with mock.patch.dict('artexinweb.settings.QUEUES',
+                         {'test_queue': queue}):
+        with mock.patch.dict('artexinweb.worker.dispatchers',
+                             {'test_queue': dispatcher}):
+            with mock.patch.dict('sys.modules',
+                                 {'huey.registry': registry_module}):
+                token = worker.create_token('test_queue')
+
+    assert token == ('huey.redis.test_queue', b'token')
+    dispatcher.task_class.assert_called_once_with(((), {}))
+    task = dispatcher.task_class.return_value
+    registry.get_message_for_task.assert_called_once_with(task)
+
+
+def test_dispatchers():
+    assert sorted(worker.dispatchers) == sorted(settings.QUEUES)
@@ -1,14 +1,32 @@
 # -*- coding: utf-8 -*-
+import copy
+import functools
 import hashlib
 import io
+import json
 import os
 import pkgutil
 import shutil
+import struct
+import sys
 import tempfile
+import urllib.parse
 import zipfile
 
+from concurrent import futures
+
 import babel
 
+from artexinweb import exceptions
+
+
+# general purpose bit flag of zip members followed by a data descriptor
+DATA_DESCRIPTOR_FLAG = 0x08
+DATA_DESCRIPTOR_SIGNATURE = b'PK\x07\x08'
+# copying the raw data of zip members relies on internals of ``zipfile``,
+# which were verified to be compatible with these Python versions only
+IS_RAW_ZIP_COPY_SUPPORTED = (3, 6) <= sys.version_info[:2] <= (3, 13)
+
 
 def discover(package):
     modules = pkgutil.iter_modules(package.__path__)
@@ -26,6 +44,53 @@ def hash_data(*args):
     return md5.hexdigest()
 
 
+def save_upload(src_file, dest_path, max_size=None, chunk_size=64 * 1024):
+    """Copy the passed in file object into a new file in chunks of
+    `chunk_size`, so the uploaded data never has to fit in memory, while
+    calculating it's MD5 checksum. If the copied data exceeds `max_size`, the
+    partially written file is removed.
+
+    :param src_file:    File-like object, read from it's current position
+    :param dest_path:   Full path of the to-be-created file
+    :param max_size:    Maximum number of bytes allowed, or ``None``
+    :param chunk_size:  Maximum number of bytes held in memory at once
+    :returns:           str: MD5 hexdigest of the copied data
+    """
+    md5 = hashlib.md5()
+    size = 0
+    with open(dest_path, 'wb') as dest_file:
+        try:
+            for chunk in iter(lambda: src_file.read(chunk_size), b''):
+                size += len(chunk)
+                if max_size is not None and size > max_size:
+                    msg = "File exceeds the size limit of {0} bytes."
+                    raise exceptions.UploadTooLarge(msg.format(max_size))
+                md5.update(chunk)
+                dest_file.write(chunk)
+        except Exception:
+            dest_file.close()
+            os.remove(dest_path)
+            raise
+
+    return md5.hexdigest()
+
+
+def normalize_url(url):
+    """Return the passed in URL in a canonical form, so different spellings of
+    the same address compare equal. The scheme and host are lowercased, the
+    fragment is dropped and an empty path is replaced by `/`.
+
+    :param url:  URL string
+    :returns:    str: normalized URL
+    """
+    parsed = urllib.parse.urlsplit(url.strip())
+    return urllib.parse.urlunsplit((parsed.scheme.lower(),
+                                    parsed.netloc.lower(),
+                                    parsed.path or '/',
+                                    parsed.query,
+                                    ''))
+
+
 def get_extension(filepath):
     return os.path.splitext(filepath)[-1].strip(".").lower()
 
@@ -51,27 +116,180 @@ def collect_locales():
     return sorted(languages, key=lambda x: x[1])
 
 
+@functools.lru_cache()
+def get_locales(cache_path):
+    """Return the languages supported by Babel, read from the file written by
+    ``save_locales`` if it exists, or collected on the spot otherwise. The
+    result is memoized, so the languages are looked up at most once per
+    process, and only when they are actually needed.
+
+    :param cache_path:  Full path to the locales cache file
+    :returns:           list of (language_code, language_name) tuples
+    """
+    try:
+        with open(cache_path, 'r', encoding='utf-8') as cache_file:
+            return [tuple(language) for language in json.load(cache_file)]
+    except (OSError, ValueError):
+        return collect_locales()
+
+
+def save_locales(cache_path):
+    """Collect the languages supported by Babel and write them into the cache
+    file read by ``get_locales``.
+
+    :param cache_path:  Full path to the locales cache file
+    """
+    with open(cache_path, 'w', encoding='utf-8') as cache_file:
+        json.dump(collect_locales(), cache_file)
+
+
 def list_zipfile(zip_filepath):
     with zipfile.ZipFile(zip_filepath, 'r') as zf:
         return zf.namelist()
 
 
-def unzip(source_filename, dest_dir):
-    with zipfile.ZipFile(source_filename) as zf:
-        for member in zf.infolist():
-            # Path traversal defense copied from
-            # http://hg.python.org/cpython/file/tip/Lib/http/server.py#l765
-            words = member.filename.split('/')
-            path = dest_dir
+def get_member_dir(member, dest_dir):
+    # Path traversal defense copied from
+    # http://hg.python.org/cpython/file/tip/Lib/http/server.py#l765
+    words = member.filename.split('/')
+    path = dest_dir
 
-            for word in words[:-1]:
-                drive, word = os.path.splitdrive(word)
-                head, word = os.path.split(word)
-                if word in (os.curdir, os.pardir, ''):
-                    continue
-                path = os.path.join(path, word)
+    for word in words[:-1]:
+        drive, word = os.path.splitdrive(word)
+        head, word = os.path.split(word)
+        if word in (os.curdir, os.pardir, ''):
+            continue
+        path = os.path.join(path, word)
 
-            zf.extract(member, path)
+    return path
+
+
+def create_member_dirs(members, dest_dir):
+    """Create the folders all the passed in members will be extracted into,
+    so threads extracting the members don't race to create them."""
+    for member in members:
+        words = [word for word in member.filename.split('/')
+                 if word not in (os.curdir, os.pardir, '')]
+        target = os.path.join(get_member_dir(member, dest_dir), *words)
+        if not member.filename.endswith('/'):
+            target = os.path.dirname(target)
+        os.makedirs(target, exist_ok=True)
+
+
+def unzip(source_filename, dest_dir, workers=1):
+    """Extract all members of a zip archive into the passed in folder. With
+    more than one worker, the members are distributed among threads, each
+    reading the archive through it's own file handle, as decompression and
+    file writes release the GIL.
+
+    :param source_filename:  Full path to the zip file
+    :param dest_dir:         Full path to the destination folder
+    :param workers:          Number of threads to extract the members with
+    """
+    with zipfile.ZipFile(source_filename) as zf:
+        members = zf.infolist()
+        if workers < 2 or len(members) < 2:
+            for member in members:
+                zf.extract(member, get_member_dir(member, dest_dir))
+            return
+
+    create_member_dirs(members, dest_dir)
+
+    def extract_members(chunk):
+        with zipfile.ZipFile(source_filename) as zf:
+            for member in chunk:
+                zf.extract(member, get_member_dir(member, dest_dir))
+
+    # spread the big members evenly among the threads
+    members.sort(key=lambda member: member.compress_size, reverse=True)
+    chunks = [members[i::workers] for i in range(workers)]
+    with futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        # consume the results, so exceptions are propagated
+        list(executor.map(extract_members, chunks))
+
+
+def copy_zip_members(zip_read, zip_write, members, chunk_size=64 * 1024):
+    """Copy the passed in members of an open zip file into another zip file
+    opened for writing. The compressed data of the members is copied as-is, in
+    chunks of `chunk_size`, so no decompression or recompression takes place.
+    On Python versions whose ``zipfile`` internals are not known to be
+    compatible, the members are decompressed and recompressed instead.
+
+    :param zip_read:    ``zipfile.ZipFile`` instance to copy from
+    :param zip_write:   ``zipfile.ZipFile`` instance opened in write mode
+    :param members:     Iterable of ``zipfile.ZipInfo`` instances of `zip_read`
+    :param chunk_size:  Maximum number of bytes held in memory at once
+    """
+    if not IS_RAW_ZIP_COPY_SUPPORTED:
+        for info in members:
+            zip_write.writestr(copy.copy(info), zip_read.read(info))
+        return
+
+    source = zip_read.fp
+    target = zip_write.fp
+    for info in members:
+        source.seek(info.header_offset)
+        header = source.read(zipfile.sizeFileHeader)
+        fields = struct.unpack(zipfile.structFileHeader, header)
+        length = (zipfile.sizeFileHeader +
+                  fields[zipfile._FH_FILENAME_LENGTH] +
+                  fields[zipfile._FH_EXTRA_FIELD_LENGTH] +
+                  info.compress_size)
+        if info.flag_bits & DATA_DESCRIPTOR_FLAG:
+            source.seek(info.header_offset + length)
+            is_zip64 = max(info.file_size,
+                           info.compress_size) > zipfile.ZIP64_LIMIT
+            length += 20 if is_zip64 else 12
+            if source.read(4) == DATA_DESCRIPTOR_SIGNATURE:
+                length += 4
+
+        new_info = copy.copy(info)
+        new_info.header_offset = target.tell()
+        source.seek(info.header_offset)
+        while length:
+            chunk = source.read(min(chunk_size, length))
+            if not chunk:
+                raise zipfile.BadZipFile("Truncated member: " + info.filename)
+            target.write(chunk)
+            length -= len(chunk)
+
+        zip_write.filelist.append(new_info)
+        zip_write.NameToInfo[new_info.filename] = new_info
+        # let ``ZipFile`` write any further members and the central directory
+        # after the copied data
+        zip_write.start_dir = target.tell()
+        zip_write._didModify = True
+
+
+def rewrite_zip(zip_filepath, removables=(), replacements=None):
+    """Rewrite a zip archive without the files specified in `removables`, and
+    with the files specified in `replacements` added. Unchanged members are
+    copied without recompression, and the original file is atomically replaced
+    by the rewritten one, so it's never seen in an incomplete state.
+
+    :param zip_filepath:  Full path to the zip file
+    :param removables:    Filenames to be removed from the zip file
+    :param replacements:  Dict of filename / data pairs to be added
+    """
+    replacements = replacements or {}
+    removables = set(removables) | set(replacements)
+    (fd, tmp_zipfile) = tempfile.mkstemp(suffix='.zip',
+                                         dir=os.path.dirname(zip_filepath))
+    try:
+        with os.fdopen(fd, 'w+b') as tmp_file:
+            with zipfile.ZipFile(zip_filepath, 'r') as zip_read:
+                with zipfile.ZipFile(tmp_file, 'w') as zip_write:
+                    members = [item for item in zip_read.infolist()
+                               if item.filename not in removables]
+                    copy_zip_members(zip_read, zip_write, members)
+                    for (filename, data) in replacements.items():
+                        zip_write.writestr(filename, data)
+
+        shutil.copymode(zip_filepath, tmp_zipfile)
+        os.replace(tmp_zipfile, zip_filepath)
+    except Exception:
+        os.remove(tmp_zipfile)
+        raise
 
 
 def remove_from_zip(zip_filepath, *removables):
@@ -80,19 +298,7 @@ def remove_from_zip(zip_filepath, *removables):
     :param zip_filepath:  Full path to the repackable zip file
     :param *removables:   Filenames to be removed from the source zipfile
     """
-    tmp_dir = tempfile.mkdtemp()
-    try:
-        tmp_zipfile = os.path.join(tmp_dir, 'tmp.zip')
-        with zipfile.ZipFile(zip_filepath, 'r') as zip_read:
-            with zipfile.ZipFile(tmp_zipfile, 'w') as zip_write:
-                for item in zip_read.infolist():
-                    if item.filename not in removables:
-                        data = zip_read.read(item.filename)
-                        zip_write.writestr(item, data)
-
-        shutil.move(tmp_zipfile, zip_filepath)
-    finally:
-        shutil.rmtree(tmp_dir)
+    rewrite_zip(zip_filepath, removables=removables)
 
 
 def replace_in_zip(zip_filepath, **replacements):
@@ -101,10 +307,7 @@ def replace_in_zip(zip_filepath, **replacements):
     :param zip_filepath:    Full path to the zip file
     :param **replacements:  Filename / data pairs
     """
-    remove_from_zip(zip_filepath, *replacements.keys())
-    with zipfile.ZipFile(zip_filepath, 'a') as zip_write:
-        for filename, data in replacements.items():
-            zip_write.writestr(filename, data)
+    rewrite_zip(zip_filepath, replacements=replacements)
 
 
 def read_from_zip(zip_filepath, filename):
@@ -1,14 +1,115 @@
 # -*- coding: utf-8 -*-
+import threading
+
+from artexinweb import cache
+from artexinweb import handlers
+from artexinweb import scheduler
+from artexinweb import settings
+from artexinweb import utils
 from artexinweb.decorators import registered
-from artexinweb.settings import huey
 
 
-@huey.task()
-def dispatch(message):
+def load_handlers():
+    """Import all the handler modules, so they register themselves. It's
+    deferred until the first message is handled, so only the processes
+    actually running the handlers pay for importing them."""
+    with load_handlers.lock:
+        if not load_handlers.loaded:
+            utils.discover(handlers)
+            load_handlers.loaded = True
+load_handlers.lock = threading.Lock()
+load_handlers.loaded = False
+
+
+def run_handlers(message):
+    load_handlers()
     try:
-        handlers = registered.handlers[message.pop('type', None)]
+        handler_funcs = registered.handlers[message.pop('type', None)]
     except KeyError:
         pass
     else:
-        for hander_func in handlers:
+        for hander_func in handler_funcs:
             hander_func(message)
+
+
+def create_dispatcher(queue_name, queue):
+    def dispatcher(message=None, priority=0):
+        # delayed messages are carried by huey until they are due
+        if message is not None:
+            scheduler.push(queue_name, message, priority)
+        message = scheduler.pop(queue_name)
+        if message is not None:
+            run_handlers(message)
+    # task names must be unique among all the queues
+    dispatcher.__name__ = 'dispatch_{0}'.format(queue_name)
+    return queue.task()(dispatcher)
+
+
+dispatchers = dict((queue_name, create_dispatcher(queue_name, queue))
+                   for (queue_name, queue) in settings.QUEUES.items())
+
+
+def create_token(queue_name):
+    """Return the key of the redis list backing the huey queue, and a
+    serialized message which calls the dispatcher of the queue, so the tokens
+    can be sent in a pipeline along with the pending messages. huey has no
+    means to enqueue tasks in a batch, so it relies on it's internals, which
+    differ between huey 0.4 and the later releases.
+
+    :param queue_name:  Name of one of the queues in ``settings.QUEUES``
+    :returns:           tuple of the list key and the message
+    """
+    queue = settings.QUEUES[queue_name]
+    dispatcher = dispatchers[queue_name]
+    if hasattr(queue, 'storage'):
+        task = dispatcher.s()
+        return (queue.storage.queue_key, queue.serialize_task(task))
+
+    from huey.registry import registry
+    task = dispatcher.task_class(((), {}))
+    return (queue.queue.queue_name, registry.get_message_for_task(task))
+
+
+def dispatch_many(messages, queue_name, priority=0, delay=None):
+    """Send the passed in messages to the workers consuming the specified
+    queue, with a single round trip to redis.
+
+    :param messages:    Iterable of dicts containing the type and ID of jobs
+    :param queue_name:  Name of one of the queues in ``settings.QUEUES``
+    :param priority:    int: priority of the messages
+    :param delay:       Optional number of seconds to wait before the messages
+                        are considered for processing
+    """
+    if not messages:
+        return
+
+    if delay:
+        for message in messages:
+            dispatch(message, queue_name, priority, delay=delay)
+        return
+
+    pipeline = cache.get_connection().pipeline(transaction=False)
+    for message in messages:
+        scheduler.push(queue_name, message, priority, pipeline=pipeline)
+        pipeline.lpush(*create_token(queue_name))
+    pipeline.execute()
+
+
+def dispatch(message, queue_name, priority=0, delay=None):
+    """Send the passed in message to the workers consuming the specified
+    queue. Messages with higher priorities are processed first, see
+    ``artexinweb.scheduler``.
+
+    :param message:     Dict containing the type and ID of the job
+    :param queue_name:  Name of one of the queues in ``settings.QUEUES``
+    :param priority:    int: priority of the message
+    :param delay:       Optional number of seconds to wait before the message
+                        is considered for processing
+    """
+    if delay:
+        dispatchers[queue_name].schedule(args=(message, priority),
+                                         delay=delay)
+        return
+
+    scheduler.push(queue_name, message, priority)
+    dispatchers[queue_name]()
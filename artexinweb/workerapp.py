@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+"""Entry point of the background workers. Each queue is consumed by it's own
+pool of workers, started with one of::
+
+    huey_consumer.py artexinweb.workerapp.fetchable_js
+    huey_consumer.py artexinweb.workerapp.fetchable_static
+    huey_consumer.py artexinweb.workerapp.standalone
+
+Unlike ``artexinweb.app``, it doesn't set up the web application, so the
+worker processes don't load the controllers, forms and templates.
+
+The consumers also reclaim the tasks of dead workers periodically, see
+``artexinweb.reaper``. Periodic tasks are run by every consumer which doesn't
+have them disabled, whichever queue it consumes, so the deployment starts all
+but the standalone workers with ``--no-periodic``.
+"""
+import logging.config
+
+import mongoengine
+
+from huey import crontab
+
+from artexinweb import reaper
+from artexinweb import settings
+# registers the dispatchers of the queues as huey tasks
+from artexinweb import worker  # NOQA
+
+
+fetchable_js = settings.QUEUES[settings.QUEUE_FETCHABLE_JS]
+fetchable_static = settings.QUEUES[settings.QUEUE_FETCHABLE_STATIC]
+standalone = settings.QUEUES[settings.QUEUE_STANDALONE]
+logging.config.dictConfig(settings.LOGGING)
+
+mongoengine.connect('', host=settings.BOTTLE_CONFIG['database.url'])
+
+
+@standalone.periodic_task(crontab(minute='*'))
+def reclaim_tasks():
+    reaper.reclaim()